@@ -0,0 +1,432 @@
+# Benchmarks for instasend.py and jungsend.py without the hardware
+#
+#  python bench.py
+#  python bench.py --only send,jeenode --json bench.json
+#  python bench.py --compare bench.json          (show the change against an earlier run)
+#
+# the INSTA transceiver (simulator.py) and the JeeNode receiver are faked
+# on pty pairs by a forked child process, so the CPU time measured is the
+# tool's own. posix only, like engine.py.
+#
+#   send      instasend one-shot path, Miniterm.send() per command
+#   daemon    instasend --daemon path, engine.InstaPort handshakes
+#   insta     jungsend receiving telegrams, engine.InstaPort + FrameParser
+#   jeenode   jungsend --jeenode receive path, RawPort + parser + SeqTracker
+#   startup   cold start of `instasend.py -c a4on` and of `import instasend`,
+#             each in a new interpreter
+
+import sys, os, time, signal, json, subprocess
+import serial
+import insta, engine, jeenode
+from simulator import Simulator, open_pty
+
+SWITCHES = sorted(insta.TELEGRAMS)
+
+
+def fake_device(target, *args):
+    """fork a child running target(fd, *args) on the master side of a new
+       pty, returns (pid, slave device name, slave fd)"""
+    master, slave, name = open_pty()
+    pid = os.fork()
+    if pid == 0:
+        os.close(slave)
+        try:
+            target(master, *args)
+        finally:
+            os._exit(0)
+    os.close(master)
+    return pid, name, slave
+
+
+def stop_device(device):
+    pid, name, slave = device
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+    os.close(slave)
+
+
+def fake_insta(fd, faults):
+    Simulator(fd, **faults).run()
+
+
+def fake_insta_sender(fd, count):
+    """send `count` switch telegrams as fast as the pty takes them"""
+    time.sleep(0.2)
+    telegrams = [insta.TELEGRAMS[name] for name in SWITCHES]
+    chunk = ''.join(telegrams)
+    sent = 0
+    while sent < count:
+        n = min(len(telegrams), count - sent)
+        os.write(fd, chunk[:n * insta.FRAME_LEN])
+        sent += n
+    time.sleep(3600)
+
+
+def meter_message(seq, watts=1234.5, kwh=98765.4):
+    payload = jeenode.ENERGY.pack(seq, 500, int(watts * 10), int(kwh * 10))
+    return 'OK %d 1 1 0 1 0 %s E\r\n' % (len(payload),
+        ' '.join([str(b) for b in bytearray(payload)]))
+
+
+def fake_jeenode(fd, count, rate=0.0):
+    """send `count` energy meter messages, `rate` per second (0: flat out)"""
+    time.sleep(0.2)
+    seq = 0
+    while seq < count:
+        if rate:
+            os.write(fd, meter_message(seq))
+            seq += 1
+            time.sleep(1.0 / rate)
+        else:
+            n = min(100, count - seq)
+            os.write(fd, ''.join([meter_message(seq + i) for i in range(n)]))
+            seq += n
+    time.sleep(3600)
+
+
+def cpu():
+    t = os.times()
+    return t[0] + t[1]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def latencies(result, values):
+    for p in (50, 90, 99):
+        result['latency_p%d_ms' % p] = percentile(values, p) * 1000
+    return result
+
+
+def bench_send(count, faults={}, ack_timeout=0.5, retries=2):
+    import instasend
+    device = fake_device(fake_insta, faults)
+    failed = 0
+    try:
+        miniterm = instasend.Miniterm(device[1], 9600, [], ack_timeout=ack_timeout, retries=retries)
+        times = []
+        start, cpu_start = time.time(), cpu()
+        for i in range(count):
+            t = time.time()
+            if miniterm.send(SWITCHES[i % len(SWITCHES)]):
+                times.append(time.time() - t)
+            else:
+                failed += 1
+        elapsed, cpu_used = time.time() - start, cpu() - cpu_start
+        miniterm.serial.close()
+    finally:
+        stop_device(device)
+    return latencies({'commands_per_s': (count - failed) / elapsed,
+                      'cpu_ms_per_command': cpu_used / count * 1000,
+                      'failed_commands': failed}, times)
+
+
+def bench_daemon(count, faults={}, ack_timeout=0.5, retries=2, frame_spacing=0.01):
+    device = fake_device(fake_insta, faults)
+    try:
+        loop = engine.Loop()
+        port = engine.InstaPort(loop, serial.Serial(device[1], 9600, timeout=0),
+                                frame_spacing=frame_spacing, ack_timeout=ack_timeout,
+                                retries=retries, answer_inq=True)
+        times = []
+        state = {'sent': 0, 'failed': 0, 'at': 0.0}
+        def send():
+            state['at'] = time.time()
+            port.send(insta.TELEGRAMS[SWITCHES[state['sent'] % len(SWITCHES)]], done)
+        def done(ok):
+            if ok:
+                times.append(time.time() - state['at'])
+                state['sent'] += 1
+            else:
+                state['failed'] += 1
+            if state['sent'] + state['failed'] < count:
+                send()
+            else:
+                loop.stop()
+        start, cpu_start = time.time(), cpu()
+        loop.call_later(0, send)
+        loop.call_later(60 + count * (retries + 1) * ack_timeout, loop.stop)
+        loop.run()
+        elapsed, cpu_used = time.time() - start, cpu() - cpu_start
+        port.close()
+    finally:
+        stop_device(device)
+    return latencies({'commands_per_s': state['sent'] / elapsed,
+                      'cpu_ms_per_command': cpu_used / max(1, state['sent']) * 1000,
+                      'failed_commands': state['failed']}, times)
+
+
+def receive(device, make_port, count, timeout):
+    """run the loop until `count` items were counted by the port's callback"""
+    loop = engine.Loop()
+    state = {'items': 0, 'first': None, 'last': None}
+    def counted(n):
+        now = time.time()
+        if state['first'] is None:
+            state['first'] = now
+        state['last'] = now
+        state['items'] += n
+        if state['items'] >= count:
+            loop.stop()
+    port = make_port(loop, serial.Serial(device[1], 57600, timeout=0), counted)
+    loop.call_later(timeout, loop.stop)
+    cpu_start = cpu()
+    loop.run()
+    cpu_used = cpu() - cpu_start
+    port.close()
+    elapsed = (state['last'] or 0) - (state['first'] or 0) or 1e-9
+    return state['items'], elapsed, cpu_used
+
+
+def bench_insta_rx(count):
+    device = fake_device(fake_insta_sender, count)
+    def make_port(loop, ser, counted):
+        def items(port, items):
+            if items:
+                counted(len([item for item in items if isinstance(item, insta.Frame)]))
+        return engine.InstaPort(loop, ser, on_items=items)
+    try:
+        frames, elapsed, cpu_used = receive(device, make_port, count, 30)
+    finally:
+        stop_device(device)
+    return {'frames_per_s': frames / elapsed,
+            'rx_bytes_per_s': frames * insta.FRAME_LEN / elapsed,
+            'cpu_us_per_frame': cpu_used / max(1, frames) * 1e6,
+            'lost_frames': count - frames}
+
+
+def bench_jeenode_rx(count, rate=0.0):
+    device = fake_device(fake_jeenode, count, rate)
+    parser = jeenode.JeeNodeParser()
+    seqs = jeenode.SeqTracker()
+    def make_port(loop, ser, counted):
+        def data(port, data):
+            if data:
+                counted(len([record for record in parser.feed(data) if seqs.check(record)]))
+        return engine.RawPort(loop, ser, data)
+    try:
+        messages, elapsed, cpu_used = receive(device, make_port, count, 30 + (rate and count / rate))
+    finally:
+        stop_device(device)
+    size = len(meter_message(count // 2))
+    return {'messages_per_s': messages / elapsed,
+            'rx_bytes_per_s': messages * size / elapsed,
+            'cpu_us_per_message': cpu_used / max(1, messages) * 1e6,
+            'lost_messages': count - messages}
+
+
+def bench_startup(runs, faults={}):
+    here = os.path.dirname(os.path.abspath(__file__))
+    devnull = open(os.devnull, 'r+')
+    device = fake_device(fake_insta, faults)
+    def timed(args):
+        times = []
+        for i in range(runs):
+            t = time.time()
+            if subprocess.call([sys.executable] + args, cwd=here, stdin=devnull, stdout=devnull):
+                raise RuntimeError("%s failed" % ' '.join(args))
+            times.append(time.time() - t)
+        return times
+    try:
+        command = timed([os.path.join(here, 'instasend.py'), '-q', '-p', device[1], '-c', 'a4on'])
+        imports = timed(['-c', 'import instasend'])
+        bare = timed(['-c', 'pass'])
+    finally:
+        stop_device(device)
+        devnull.close()
+    return {'command_p50_ms': percentile(command, 50) * 1000,
+            'command_p90_ms': percentile(command, 90) * 1000,
+            'import_p50_ms': percentile(imports, 50) * 1000,
+            'interpreter_p50_ms': percentile(bare, 50) * 1000}
+
+
+BENCHMARKS = ('send', 'daemon', 'insta', 'jeenode', 'startup')
+
+
+def run(names, options):
+    faults = {'ack_delay': options.ack_delay, 'ack_jitter': options.ack_jitter,
+              'drop_ack': options.drop_ack, 'corrupt_ack': options.corrupt_ack,
+              'garbage': options.garbage, 'chatter': options.chatter,
+              'noise': options.noise, 'seed': options.seed}
+    results = {}
+    for name in names:
+        if name == 'send':
+            results[name] = bench_send(options.commands, faults, options.ack_timeout, options.retries)
+        elif name == 'daemon':
+            results[name] = bench_daemon(options.commands, faults, options.ack_timeout, options.retries)
+        elif name == 'insta':
+            results[name] = bench_insta_rx(options.frames)
+        elif name == 'jeenode':
+            results[name] = bench_jeenode_rx(options.messages, options.rate)
+        elif name == 'startup':
+            results[name] = bench_startup(options.runs, faults)
+    return results
+
+
+def report(results, previous=None):
+    for name in BENCHMARKS:
+        if name not in results:
+            continue
+        for key, value in sorted(results[name].items()):
+            line = "%-8s %-22s %12.3f" % (name, key, value)
+            old = previous and previous.get(name, {}).get(key)
+            if old:
+                line += "   %+6.1f%%" % ((value - old) / old * 100)
+            sys.stdout.write(line + "\n")
+
+
+def main():
+    import optparse
+
+    parser = optparse.OptionParser(
+        usage = "%prog [options]",
+        description = "Bench - measure instasend and jungsend against fake devices on pty pairs."
+    )
+
+    parser.add_option("--only",
+        dest = "only",
+        help = "comma separated benchmarks to run (%s)" % ', '.join(BENCHMARKS),
+        default = ','.join(BENCHMARKS)
+    )
+
+    parser.add_option("--commands",
+        dest = "commands",
+        type = "int",
+        help = "commands sent by the send and daemon benchmarks, default %default",
+        default = 200
+    )
+
+    parser.add_option("--ack-delay",
+        dest = "ack_delay",
+        type = "float",
+        help = "seconds the simulated transceiver waits before ACKing, default %default",
+        default = 0.0
+    )
+
+    parser.add_option("--ack-jitter",
+        dest = "ack_jitter",
+        type = "float",
+        help = "up to this many seconds added to the ACK delay, default %default",
+        default = 0.0
+    )
+
+    parser.add_option("--drop-ack",
+        dest = "drop_ack",
+        type = "float",
+        help = "probability that the simulated transceiver ignores an INQ, default %default",
+        default = 0.0
+    )
+
+    parser.add_option("--corrupt-ack",
+        dest = "corrupt_ack",
+        type = "float",
+        help = "probability that a wrong byte is sent instead of ACK, default %default",
+        default = 0.0
+    )
+
+    parser.add_option("--garbage",
+        dest = "garbage",
+        type = "float",
+        help = "probability of random bytes in front of an ACK, default %default",
+        default = 0.0
+    )
+
+    parser.add_option("--chatter",
+        dest = "chatter",
+        type = "float",
+        help = "unsolicited telegrams per second from the simulated transceiver, default %default",
+        default = 0.0
+    )
+
+    parser.add_option("--noise",
+        dest = "noise",
+        type = "float",
+        help = "probability of a corrupted byte in an unsolicited telegram, default %default",
+        default = 0.0
+    )
+
+    parser.add_option("--seed",
+        dest = "seed",
+        type = "int",
+        help = "seed of the simulated faults, default %default",
+        default = 1
+    )
+
+    parser.add_option("--ack-timeout",
+        dest = "ack_timeout",
+        type = "float",
+        help = "ACK timeout of the senders, default %default",
+        default = 0.5
+    )
+
+    parser.add_option("--retries",
+        dest = "retries",
+        type = "int",
+        help = "INQ retries of the senders, default %default",
+        default = 2
+    )
+
+    parser.add_option("--frames",
+        dest = "frames",
+        type = "int",
+        help = "telegrams received by the insta benchmark, default %default",
+        default = 20000
+    )
+
+    parser.add_option("--messages",
+        dest = "messages",
+        type = "int",
+        help = "meter messages received by the jeenode benchmark, default %default",
+        default = 20000
+    )
+
+    parser.add_option("--rate",
+        dest = "rate",
+        type = "float",
+        help = "meter messages per second, 0 sends as fast as possible, default %default",
+        default = 0.0
+    )
+
+    parser.add_option("--runs",
+        dest = "runs",
+        type = "int",
+        help = "processes started by the startup benchmark, default %default",
+        default = 20
+    )
+
+    parser.add_option("--json",
+        dest = "json",
+        help = "write the results to this file",
+        default = None
+    )
+
+    parser.add_option("--compare",
+        dest = "compare",
+        help = "results file of an earlier run to compare with",
+        default = None
+    )
+
+    (options, args) = parser.parse_args()
+
+    names = [name.strip() for name in options.only.split(',') if name.strip()]
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %r" % name)
+    previous = None
+    if options.compare:
+        previous = json.load(open(options.compare))
+
+    results = run(names, options)
+    report(results, previous)
+    if options.json:
+        f = open(options.json, 'w')
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.close()
+
+
+if __name__ == '__main__':
+    main()
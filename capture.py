@@ -0,0 +1,250 @@
+# Capture files of serial traffic and their replay through the decoders
+#
+#  python jungsend.py --port /dev/ttyUSB2 -c x --capture field.cap
+#  python capture.py field.cap                 (replay at recorded speed)
+#  python capture.py field.cap --speed 60      (an hour per minute)
+#  python capture.py field.cap --max --quiet   (as fast as possible, stats only)
+#
+# a capture is a header followed by one record per chunk read from or
+# written to the port:
+#   header  'ICAP', version (u8), port type (u8, 0 insta / 1 jeenode), start epoch (double)
+#   record  microseconds since the start (u64, monotonic), direction (u8, 0 rx / 1 tx),
+#           length (u16), the bytes
+# the file is written through a binary DataLog, so it is buffered and
+# synced like the other logs.
+
+import sys, os, time, struct
+from datalog import DataLog
+
+MAGIC = 'ICAP'
+VERSION = 1
+HEADER = struct.Struct('<4sBBd')
+RECORD = struct.Struct('<QBH')
+
+RX = 0
+TX = 1
+
+KINDS = ('insta', 'jeenode')
+
+
+def _clock():
+    """a monotonic clock in seconds, time.time() where there is none"""
+    try:
+        import ctypes, ctypes.util
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or None, use_errno=True)
+        clock_gettime = librt.clock_gettime
+        ts = timespec()
+        CLOCK_MONOTONIC = 1
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            raise OSError()
+    except (ImportError, OSError, AttributeError):
+        return time.time
+    def monotonic():
+        clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = _clock()
+
+
+class CaptureWriter:
+    """record the chunks of one port, `kind` is 'insta' or 'jeenode'.
+       record(direction, data) fits the tap of engine.InstaPort/RawPort."""
+    def __init__(self, path, kind, sync_interval=10.0, sync_records=1000):
+        started = None
+        if os.path.exists(path) and os.path.getsize(path):
+            f = open(path, 'r+b')
+            try:
+                saved_kind, started = read_header(f, path)
+                if saved_kind != kind:
+                    raise ValueError("%s is not a %s capture" % (path, kind))
+                # a record torn by a power cut, appending after it would
+                # turn everything that follows into garbage
+                end = complete_records(f)
+                if end < os.fstat(f.fileno()).st_size:
+                    f.truncate(end)
+            finally:
+                f.close()
+        self.log = DataLog(path, sync_interval, sync_records, binary=True)
+        if started is not None:
+            # appending to an earlier capture: keep its time base
+            self.origin = monotonic() - (time.time() - started)
+        else:
+            self.origin = monotonic()
+            self.log.write(HEADER.pack(MAGIC, VERSION, KINDS.index(kind), time.time()))
+
+    def record(self, direction, data):
+        offset = 0
+        while True:                 # split what does not fit in a u16 length
+            chunk = data[offset:offset + 0xffff]
+            self.log.write(RECORD.pack(int((monotonic() - self.origin) * 1e6), direction, len(chunk)) + chunk)
+            offset += 0xffff
+            if offset >= len(data):
+                break
+
+    def tick(self):
+        self.log.tick()
+
+    def close(self):
+        self.log.close()
+
+
+def read_header(f, path):
+    """(kind, start epoch) of the capture open as `f`, raises ValueError"""
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise ValueError("%s is too short for a capture" % path)
+    magic, version, kind, started = HEADER.unpack(header)
+    if magic != MAGIC or kind >= len(KINDS):
+        raise ValueError("%s is not a capture file" % path)
+    if version != VERSION:
+        raise ValueError("%s is a version %d capture, not %d" % (path, version, VERSION))
+    return KINDS[kind], started
+
+
+def complete_records(f):
+    """offset of the end of the last complete record, `f` is just past the header"""
+    size = os.fstat(f.fileno()).st_size
+    end = f.tell()
+    while True:
+        head = f.read(RECORD.size)
+        if len(head) < RECORD.size:
+            return end
+        usec, direction, length = RECORD.unpack(head)
+        if end + RECORD.size + length > size:
+            return end
+        end += RECORD.size + length
+        f.seek(end)
+
+
+def read_capture(path):
+    """(kind, start epoch, generator of (seconds since start, direction, data))"""
+    f = open(path, 'rb')
+    try:
+        kind, started = read_header(f, path)
+    except ValueError:
+        f.close()
+        raise
+    def records():
+        try:
+            while True:
+                head = f.read(RECORD.size)
+                if len(head) < RECORD.size:
+                    return          # end, or a record cut off by a crash
+                usec, direction, length = RECORD.unpack(head)
+                data = f.read(length)
+                if len(data) < length:
+                    return
+                yield usec / 1e6, direction, data
+        finally:
+            f.close()
+    return kind, started, records()
+
+
+def replay(path, speed=1.0, out=None, tx=False):
+    """feed the received chunks of a capture through the decoders, `speed`
+       times as fast as they were recorded (None: no waiting). decoded
+       records are written to `out` if given. returns a dict of counters.
+    """
+    import insta, jeenode
+    kind, started, records = read_capture(path)
+    if kind == 'insta':
+        parser = insta.FrameParser()
+        describe = insta.describe
+        def decode(data):
+            return [item for item in parser.feed(data) if isinstance(item, insta.Frame)]
+    else:
+        parser = jeenode.JeeNodeParser()
+        seqs = jeenode.SeqTracker()
+        describe = jeenode.describe
+        def decode(data):
+            return [record for record in parser.feed(data)
+                    if not hasattr(record, 'seq') or seqs.check(record)]
+    stats = {'chunks': 0, 'bytes': 0, 'records': 0, 'tx_chunks': 0, 'span': 0.0}
+    begin = time.time()
+    for offset, direction, data in records:
+        if speed is not None:
+            delay = begin + offset / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        stats['span'] = offset
+        if direction == TX:
+            stats['tx_chunks'] += 1
+            if tx and out is not None:
+                out.write("%10.3f > %s\n" % (offset, ' '.join(['%02x' % b for b in bytearray(data)])))
+            continue
+        stats['chunks'] += 1
+        stats['bytes'] += len(data)
+        decoded = decode(data)
+        stats['records'] += len(decoded)
+        if out is not None:
+            for record in decoded:
+                out.write("%10.3f %s\n" % (offset, describe(record)))
+    stats['elapsed'] = time.time() - begin
+    stats['errors'] = parser.errors
+    if kind == 'jeenode':
+        stats['seq'] = seqs.describe()
+    return stats
+
+
+def main():
+    import optparse
+
+    parser = optparse.OptionParser(
+        usage = "%prog [options] capture",
+        description = "Capture - replay recorded serial traffic through the INSTA or JeeNode decoders."
+    )
+
+    parser.add_option("--speed",
+        dest = "speed",
+        type = "float",
+        help = "replay this many times as fast as recorded, default %default",
+        default = 1.0
+    )
+
+    parser.add_option("--max",
+        dest = "max",
+        action = "store_true",
+        help = "replay as fast as possible",
+        default = False
+    )
+
+    parser.add_option("--tx",
+        dest = "tx",
+        action = "store_true",
+        help = "also show the bytes that were sent",
+        default = False
+    )
+
+    parser.add_option("-q", "--quiet",
+        dest = "quiet",
+        action = "store_true",
+        help = "only print the statistics",
+        default = False
+    )
+
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("give one capture file")
+    if options.speed <= 0:
+        parser.error("--speed must be positive")
+
+    try:
+        stats = replay(args[0], not options.max and options.speed or None,
+                       not options.quiet and sys.stdout or None, options.tx)
+    except (IOError, ValueError), e:
+        sys.stderr.write("could not replay: %s\n" % e)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        sys.exit(1)
+    sys.stderr.write("--- %d chunks, %d bytes, %d records, %d errors, %.1fs of traffic in %.3fs ---\n" % (
+        stats['chunks'], stats['bytes'], stats['records'], stats['errors'],
+        stats['span'], stats['elapsed']))
+    for line in stats.get('seq', []):
+        sys.stderr.write("--- %s\n" % line)
+
+
+if __name__ == '__main__':
+    main()
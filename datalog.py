@@ -0,0 +1,110 @@
+# Append-only data logs for the JeeNode receiver (data_raw.dat, data_energy.dat)
+#
+# jungsend.c opened, wrote and closed the file for every message. a DataLog
+# keeps the file open, buffers the lines and only flushes and fsyncs every
+# `sync_interval` seconds or `sync_records` records, which is what an SD
+# card wants. the file can be rotated by size and/or age.
+
+import os, time
+
+BUFFER_SIZE = 64 * 1024
+
+
+class DataLog:
+    """line oriented log file kept open between records.
+
+       data is flushed and fsynced when `sync_records` lines were written or
+       `sync_interval` seconds passed since the last sync, whichever comes
+       first (call tick() periodically so an idle log still gets synced).
+       when the file is larger than `max_bytes` or older than `max_age`
+       seconds it is renamed to <path>.<YYYYmmdd-HHMMSS> and a new one
+       started; None disables either limit. with `binary` set the records
+       are written as they are, without newline translation.
+
+       with max_age the time a file was started is kept in <path>.created,
+       the mtime of a busy log is always about now, so a restart would
+       start the age over.
+    """
+    def __init__(self, path, sync_interval=10.0, sync_records=100, max_bytes=None, max_age=None, binary=False):
+        self.path = path
+        self.mode = binary and 'ab' or 'a'
+        self.sync_interval = sync_interval
+        self.sync_records = sync_records
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.file = None
+        self.open()
+
+    def open(self):
+        self.file = open(self.path, self.mode, BUFFER_SIZE)
+        self.size = os.path.getsize(self.path)
+        self.created = time.time()
+        if self.max_age is not None:
+            self.created = self.started()
+        self.unsynced = 0
+        self.synced_at = time.time()
+
+    def started(self):
+        """when the file was started, from <path>.created; written now for
+           a new file (or one that has none, its age counts from now on)"""
+        stamp = self.path + '.created'
+        if self.size:
+            try:
+                f = open(stamp)
+                try:
+                    return float(f.read())
+                finally:
+                    f.close()
+            except (IOError, ValueError):
+                pass
+        created = time.time()
+        f = open(stamp, 'w')
+        try:
+            f.write("%.3f\n" % created)
+        finally:
+            f.close()
+        return created
+
+    def write(self, data):
+        if self.rotate_due():
+            self.rotate()
+        self.file.write(data)
+        self.size += len(data)
+        self.unsynced += 1
+        if self.unsynced >= self.sync_records:
+            self.sync()
+
+    def tick(self):
+        """sync if there is unsynced data older than sync_interval"""
+        if self.unsynced and time.time() - self.synced_at >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.synced_at = time.time()
+
+    def rotate_due(self):
+        if self.max_bytes is not None and self.size >= self.max_bytes:
+            return True
+        if self.max_age is not None and time.time() - self.created >= self.max_age:
+            return True
+        return False
+
+    def rotate(self):
+        self.close()
+        base = "%s.%s" % (self.path, time.strftime('%Y%m%d-%H%M%S'))
+        target = base
+        n = 1
+        while os.path.exists(target):
+            target = "%s.%d" % (base, n)
+            n += 1
+        os.rename(self.path, target)
+        self.open()
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
@@ -0,0 +1,173 @@
+# Transmit airtime budget of a radio on a licence-free band
+#
+# the licence-free bands the transceivers use allow a transmitter on the
+# air for a share of the time only (1% in the 868.0-868.6 MHz sub-band,
+# 10% in some others), measured over an hour. DutyCycle is a token bucket of airtime
+# per transceiver: telegrams wait for budget instead of being dropped, a
+# batch scene goes out as fast as the bucket allows and utilization is
+# reported next to the send latencies.
+#
+# a token bucket lets capacity + rate * window through in any window, so
+# `burst` splits the budget of a window between the bucket (sent at once)
+# and the refill rate (sustained), the sum never exceeds the duty cycle.
+#
+# pacing is off unless asked for (--duty-cycle): TELEGRAM_AIRTIME is not
+# measured. a daemon keeps its bucket in memory, one-shot runs share one
+# through a state file (--duty-state), otherwise every run would start
+# with a full bucket and only a batch within one run would be paced.
+# the file is:  <tokens> <epoch of tokens>, then <epoch> <airtime> per
+# transmission in the last window. save() adds what this run spent to
+# what is on disk then, so overlapping runs do not lose each other's.
+
+import os, errno, time
+from collections import deque
+
+DUTY_CYCLE = 0.01               # the strictest common sub-band
+WINDOW = 3600.0                 # seconds the duty cycle is measured over
+BURST = 0.5                     # share of the window budget usable at once
+
+# seconds on the air per telegram. the transceiver repeats every telegram
+# a few times, this is a conservative guess; measure yours and set --airtime
+TELEGRAM_AIRTIME = 0.1
+
+
+def read_bucket(path):
+    """(tokens, epoch of tokens, [(when, airtime)]) saved in `path`, None if
+       there is no file, ValueError if it is damaged"""
+    try:
+        f = open(path)
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    try:
+        tokens, updated = [float(x) for x in f.readline().split()]
+        recent = []
+        for line in f:
+            when, airtime = [float(x) for x in line.split()]
+            recent.append((when, airtime))
+    finally:
+        f.close()
+    return tokens, updated, recent
+
+
+class DutyCycle:
+    """token bucket of airtime in seconds, e.g. at 1% over an hour with
+       burst 0.5: 18 s of airtime at once, then 18 s per hour."""
+    def __init__(self, duty_cycle=DUTY_CYCLE, airtime=TELEGRAM_AIRTIME, window=WINDOW, burst=BURST):
+        if not 0 < duty_cycle <= 1:
+            raise ValueError("duty cycle must be above 0 and at most 1, not %r" % duty_cycle)
+        if not 0 <= burst < 1:
+            raise ValueError("burst must be at least 0 and below 1, not %r" % burst)
+        if airtime <= 0 or airtime >= duty_cycle * window:
+            raise ValueError("airtime %r does not fit in a %.0f s window at %g" % (airtime, window, duty_cycle))
+        self.duty_cycle = duty_cycle
+        self.airtime = airtime
+        self.window = window
+        self.capacity = max(airtime, burst * duty_cycle * window)
+        self.rate = (duty_cycle * window - self.capacity) / window
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.recent = deque()       # (when, airtime) within the last window
+        self.recent_airtime = 0.0
+        self.unsaved = []           # (when, airtime) spent since load() or save()
+        self.transmissions = 0
+        self.waits = 0              # transmissions that had to wait for budget
+        self.waited = 0.0
+        self.used = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, airtime=None):
+        """seconds until `airtime` (default one telegram) may be spent, 0 now"""
+        self._refill(time.time())
+        missing = (airtime or self.airtime) - self.tokens
+        if missing <= 0:
+            return 0.0
+        return missing / self.rate
+
+    def waiting(self, seconds):
+        """count a transmission that waits `seconds` for budget"""
+        self.waits += 1
+        self.waited += seconds
+
+    def spend(self, airtime=None):
+        """a telegram went on the air"""
+        airtime = airtime or self.airtime
+        now = time.time()
+        self._refill(now)
+        self.tokens -= airtime
+        self.transmissions += 1
+        self.used += airtime
+        self.recent.append((now, airtime))
+        self.recent_airtime += airtime
+        self.unsaved.append((now, airtime))
+
+    def utilization(self):
+        """share of the time on the air over the last window, the measure
+           the duty cycle is defined by"""
+        now = time.time()
+        while self.recent and self.recent[0][0] <= now - self.window:
+            self.recent_airtime -= self.recent.popleft()[1]
+        return self.recent_airtime / self.window
+
+    def _set(self, tokens, updated, recent):
+        self.tokens = min(self.capacity, tokens)
+        self.updated = min(updated, time.time())
+        self.recent = deque(recent)
+        self.recent_airtime = sum([airtime for when, airtime in self.recent])
+        self._refill(time.time())
+
+    def load(self, path):
+        """continue from the bucket saved in `path` by an earlier run"""
+        try:
+            bucket = read_bucket(path)
+        except ValueError:
+            # damaged: assume the worst, an empty bucket now
+            bucket = 0.0, time.time(), []
+        if bucket is not None:
+            self._set(*bucket)
+        self.unsaved = []
+
+    def save(self, path):
+        """write the bucket for the next run, replaced in one piece, with
+           what other runs saved since load() in it"""
+        try:
+            bucket = read_bucket(path)
+        except ValueError:
+            bucket = None
+        if bucket is not None:
+            tokens, updated, recent = bucket
+            self._set(tokens, updated, sorted(recent + self.unsaved))
+            self.tokens -= sum([airtime for when, airtime in self.unsaved])
+        self.unsaved = []
+        self.utilization()          # drops what is out of the window
+        tmp = '%s.%d' % (path, os.getpid())
+        f = open(tmp, 'w')
+        try:
+            f.write("%.6f %.3f\n" % (self.tokens, self.updated))
+            for when, airtime in self.recent:
+                f.write("%.3f %.6f\n" % (when, airtime))
+        finally:
+            f.close()
+        if os.name != 'posix' and os.path.exists(path):
+            os.remove(path)         # rename does not replace files there
+        os.rename(tmp, path)
+
+    def counters(self):
+        return {'telegrams_on_air': self.transmissions, 'duty_cycle_waits': self.waits}
+
+    def gauges(self):
+        self._refill(time.time())
+        utilization = self.utilization()
+        return {'utilization': utilization, 'duty_cycle_used': utilization / self.duty_cycle,
+                'airtime_seconds': self.used, 'airtime_available_seconds': max(0.0, self.tokens),
+                'duty_cycle_waited_seconds': self.waited}
+
+    def describe(self):
+        return "%d transmissions, %.1f s on air, %.3f%% utilization (%.0f%% of the %g%% allowed), %d waited %.1f s" % (
+            self.transmissions, self.used, self.utilization() * 100,
+            self.utilization() / self.duty_cycle * 100, self.duty_cycle * 100,
+            self.waits, self.waited)
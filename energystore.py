@@ -0,0 +1,177 @@
+# Binary time series store for energy meter readings (data_energy.dat)
+#
+# one fixed size little endian record per reading:
+#   epoch (double), device (u16), seq (u32), frequency, W, kWh (tenths, u16/u32/u32)
+# records are appended in time order, so a time range is found with a
+# sparse in-memory index and a binary search on the memory mapped file. readers get plain records or,
+# when numpy is installed, column arrays straight from the mapping.
+
+import os, mmap, struct, bisect
+from collections import namedtuple
+from datalog import DataLog
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+RECORD = struct.Struct('<dHIHII')
+EPOCH = struct.Struct('<d')
+
+Record = namedtuple('Record', 'epoch device seq frequency watts kwh')
+
+if numpy is not None:
+    DTYPE = numpy.dtype([('epoch', '<f8'), ('device', '<u2'), ('seq', '<u4'),
+                         ('frequency', '<u2'), ('watts', '<u4'), ('kwh', '<u4')])
+
+
+class EnergyWriter:
+    """append jeenode.Reading records to the store. buffering and fsync
+       work like DataLog (which does the writing), the file is never rotated.
+       with `rollups` set, the minute/hour/day rollups (see rollup.py) are
+       kept up to date as well.
+    """
+    def __init__(self, path, sync_interval=10.0, sync_records=100, rollups=False):
+        if os.path.exists(path) and os.path.getsize(path) % RECORD.size:
+            # a torn record from a power cut, appending after it would
+            # shift every record that follows
+            f = open(path, 'r+b')
+            f.truncate(os.path.getsize(path) // RECORD.size * RECORD.size)
+            f.close()
+        self.log = DataLog(path, sync_interval, sync_records, binary=True)
+        self.rollups = None
+        if rollups:
+            import rollup       # rollup imports this module
+            self.rollups = rollup.Rollups(path)
+        self.last = 0.0
+        if self.log.size >= RECORD.size:
+            f = open(path, 'rb')
+            f.seek(self.log.size // RECORD.size * RECORD.size - RECORD.size)
+            self.last = EPOCH.unpack(f.read(EPOCH.size))[0]
+            f.close()
+
+    def append(self, epoch, reading):
+        # keep the epochs sorted for the readers' binary search, even if
+        # the clock steps back
+        epoch = max(epoch, self.last)
+        self.last = epoch
+        self.log.write(RECORD.pack(epoch, reading.device, reading.seq,
+                                   int(round(reading.frequency * 10)),
+                                   int(round(reading.watts * 10)),
+                                   int(round(reading.kwh * 10))))
+        if self.rollups is not None:
+            self.rollups.add(epoch, reading)
+
+    def tick(self):
+        self.log.tick()
+        if self.rollups is not None:
+            self.rollups.flush()
+
+    def close(self):
+        self.log.close()
+        if self.rollups is not None:
+            self.rollups.close()
+
+
+class RecordFile:
+    """memory mapped, read-only view of a file of fixed size records whose
+       first field is a non-decreasing epoch (double). call refresh() to
+       see records appended since it was opened.
+
+       a sparse index keeps the epoch of every INDEX_STEP'th record in
+       memory, so find() only touches the pages of one block of the file.
+    """
+    INDEX_STEP = 512
+
+    def __init__(self, path, record):
+        self.path = path
+        self.struct = record
+        self.file = open(path, 'rb')
+        self.map = None
+        self.count = 0
+        self.index = []
+        self.refresh()
+
+    def refresh(self):
+        size = os.fstat(self.file.fileno()).st_size
+        count = size // self.struct.size
+        if count == self.count and self.map is not None:
+            return
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.count = count
+        if count:
+            self.map = mmap.mmap(self.file.fileno(), count * self.struct.size, access=mmap.ACCESS_READ)
+        for i in xrange(len(self.index) * self.INDEX_STEP, count, self.INDEX_STEP):
+            self.index.append(self.epoch(i))
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def __len__(self):
+        return self.count
+
+    def epoch(self, i):
+        return EPOCH.unpack_from(self.map, i * self.struct.size)[0]
+
+    def find(self, t):
+        """index of the first record with epoch >= t"""
+        block = bisect.bisect_left(self.index, t)
+        lo = max(0, (block - 1) * self.INDEX_STEP)
+        hi = min(self.count, block * self.INDEX_STEP)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.epoch(mid) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def span(self, start=None, end=None):
+        """(first, last) record indexes for start <= epoch < end"""
+        first = 0
+        last = self.count
+        if start is not None:
+            first = self.find(start)
+        if end is not None:
+            last = self.find(end)
+        return first, max(first, last)
+
+    def unpack(self, i):
+        return self.struct.unpack_from(self.map, i * self.struct.size)
+
+
+class EnergyReader(RecordFile):
+    """read-only view of an energy store"""
+    def __init__(self, path):
+        RecordFile.__init__(self, path, RECORD)
+
+    def record(self, i):
+        epoch, device, seq, freq, watts, kwh = self.unpack(i)
+        return Record(epoch, device, seq, freq / 10.0, watts / 10.0, kwh / 10.0)
+
+    def records(self, start=None, end=None):
+        first, last = self.span(start, end)
+        return [self.record(i) for i in xrange(first, last)]
+
+    def array(self, start=None, end=None):
+        """the raw records for a time range as a numpy structured array,
+           a view on the mapping (frequency/watts/kwh still in tenths)"""
+        if numpy is None:
+            raise ImportError("EnergyReader.array() needs numpy")
+        first, last = self.span(start, end)
+        if first == last:
+            return numpy.zeros(0, DTYPE)
+        return numpy.frombuffer(self.map, DTYPE, last - first, first * RECORD.size)
+
+    def arrays(self, start=None, end=None):
+        """dict of column arrays for a time range, values scaled to units"""
+        a = self.array(start, end)
+        columns = {'epoch': a['epoch'], 'device': a['device'], 'seq': a['seq']}
+        for name in ('frequency', 'watts', 'kwh'):
+            columns[name] = a[name] / 10.0
+        return columns
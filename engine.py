@@ -0,0 +1,614 @@
+# Single threaded serial engine: a small select() based event loop that
+# drives INSTA transceivers, command sockets and the console together.
+#
+# python 2 has no asyncio, this is the part of it we need: fd readers and
+# writers, timers and a thread safe way to hand work to the loop. it needs
+# selectable file descriptors for the serial ports, i.e. a posix system.
+
+import os, io, time, heapq, select, socket, errno, threading, Queue
+from collections import deque
+import serial
+import insta
+from metrics import DISABLED
+
+RX = 0                          # directions of a tap, as in capture.py
+TX = 1
+
+# seconds of silence after which the held start of a telegram is noise. a
+# telegram takes 12.5 ms at 9600 baud, usb serial adapters hold reads back
+# for up to 16 ms
+STALL_TIMEOUT = 0.1
+
+
+class Loop:
+    """run callbacks when file descriptors become readable/writable or
+       timers expire, until stop() is called"""
+    def __init__(self):
+        self.readers = {}
+        self.writers = {}
+        self.timers = []            # heap of [when, seq, callback, args]
+        self.seq = 0
+        self.running = False
+        self.pending = []           # callbacks handed in from other threads
+        self.lock = threading.Lock()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.add_reader(self.wakeup_r, self._wakeup)
+
+    def add_reader(self, fd, callback):
+        self.readers[fd] = callback
+
+    def remove_reader(self, fd):
+        self.readers.pop(fd, None)
+
+    def add_writer(self, fd, callback):
+        self.writers[fd] = callback
+
+    def remove_writer(self, fd):
+        self.writers.pop(fd, None)
+
+    def call_later(self, delay, callback, *args):
+        """run callback(*args) after `delay` seconds, returns a handle for cancel()"""
+        self.seq += 1
+        timer = [time.time() + delay, self.seq, callback, args]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def cancel(self, timer):
+        timer[2] = None
+
+    def call_soon_threadsafe(self, callback, *args):
+        """run callback(*args) in the loop thread, callable from any thread"""
+        self.lock.acquire()
+        try:
+            self.pending.append((callback, args))
+        finally:
+            self.lock.release()
+        os.write(self.wakeup_w, 'x')
+
+    def _wakeup(self):
+        os.read(self.wakeup_r, 512)
+        self.lock.acquire()
+        try:
+            pending, self.pending = self.pending, []
+        finally:
+            self.lock.release()
+        for callback, args in pending:
+            callback(*args)
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        self.running = True
+        while self.running:
+            timeout = None
+            if self.timers:
+                timeout = max(0, self.timers[0][0] - time.time())
+            try:
+                readable, writable, x = select.select(self.readers.keys(), self.writers.keys(), [], timeout)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in readable:
+                callback = self.readers.get(fd)
+                if callback is not None:
+                    callback()
+            for fd in writable:
+                callback = self.writers.get(fd)
+                if callback is not None:
+                    callback()
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                when, seq, callback, args = heapq.heappop(self.timers)
+                if callback is not None:
+                    callback(*args)
+
+
+RX_POLICIES = ('drop-oldest', 'drop-newest', 'block')
+
+class RxQueue(Queue.Queue):
+    """bounded queue of (timestamp, insta.Frame) received from the radio.
+       when it is full, `policy` decides what publish() does:
+         drop-oldest: discard the oldest entry to make room (default)
+         drop-newest: discard the new entry
+         block:       wait until a consumer makes room
+       discarded entries are counted in `dropped`.
+    """
+    def __init__(self, maxsize=2048, policy='drop-oldest'):
+        if policy not in RX_POLICIES:
+            raise ValueError("unknown overflow policy %r" % policy)
+        Queue.Queue.__init__(self, maxsize)
+        self.policy = policy
+        self.dropped = 0
+
+    def publish(self, item):
+        if self.policy == 'block':
+            self.put(item)
+            return
+        while True:
+            try:
+                self.put_nowait(item)
+                return
+            except Queue.Full:
+                self.dropped += 1
+                if self.policy == 'drop-newest':
+                    return
+                try:
+                    self.get_nowait()
+                except Queue.Empty:
+                    pass
+
+
+class RxBuffer:
+    """preallocated receive buffer of a serial port.
+
+       fill() reads what is waiting straight into the free space with
+       readinto(), the parser works on buf[start:end] in place and
+       consume() moves start past what it used. when the end of the buffer
+       is reached the unparsed tail is moved to the front, so steady-state
+       reception allocates nothing per read. if unparsed bytes fill the
+       whole buffer they are dropped and counted in `overflows`.
+    """
+    def __init__(self, fd, size=4096):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        self.overflows = 0
+        self.file = io.FileIO(fd, 'r', closefd=False)
+
+    def fill(self):
+        """read from the port, returns the number of bytes, None when
+           nothing is waiting and 0 at the end of the file (the device
+           went away)"""
+        if self.end == len(self.buf):
+            if self.start == 0:
+                self.overflows += 1
+                self.start = self.end
+            self.view[:self.end - self.start] = self.view[self.start:self.end]
+            self.end -= self.start
+            self.start = 0
+        n = self.file.readinto(self.view[self.end:])
+        if n:
+            self.end += n
+        return n
+
+    def consume(self, pos):
+        self.start = pos
+        if pos == self.end:
+            self.start = self.end = 0
+
+
+class InstaPort:
+    """an INSTA transceiver driven by a Loop.
+
+       received bytes are decoded with insta.FrameParser: telegrams are
+       published to `rx_queue` (an RxQueue, if given), INQs from the radio
+       are answered with ACK when `answer_inq` is set, and the items of
+       every chunk are passed to on_items(port, items). the transceiver
+       only hands over a received telegram after its INQ was ACKed, so
+       anything that wants telegrams needs answer_inq. when its INQ
+       crosses ours, ours is dropped and asked again once the telegram
+       came in (or after ack_timeout), that does not count as a retry.
+
+       write() queues raw bytes, writes are at least `frame_spacing` seconds
+       apart (counted from the end of the previous transmission). send()
+       runs the INQ -> ACK -> telegram handshake, one telegram at a time.
+
+       with a metrics.Metrics the phases of every send are timed: queue
+       (waiting for earlier sends), inq_write (frame spacing until the INQ
+       is written), ack, telegram_write and send (all of it). writes are
+       not drained, so there is no flush phase.
+
+       tap(direction, data), if given, sees every chunk read (capture.RX)
+       and written (capture.TX), e.g. capture.CaptureWriter.record.
+
+       the start of a telegram that is not complete after STALL_TIMEOUT
+       seconds of silence is handed out as Control items, see
+       insta.FrameParser.
+
+       receive ceiling, python 2.7 on x86 through a pty: the threaded
+       reader of jungsend.py this replaced read about 0.9 MB/s end to end
+       and 1.2 MB/s for FrameParser alone; `bench.py --only insta` on this
+       loop reads 1.6-3.0 MB/s. a 9600 baud transceiver sends 0.96 kB/s.
+
+       with a dutycycle.DutyCycle as `duty` a handshake only starts when
+       the transceiver has airtime left for the telegram, until then sends
+       stay queued (and the queue phase grows).
+    """
+    def __init__(self, loop, serial, rx_queue=None, on_items=None, frame_spacing=0.01,
+                 ack_timeout=0.5, retries=2, answer_inq=False, name=None, metrics=None, tap=None,
+                 duty=None):
+        self.loop = loop
+        self.serial = serial
+        self.name = name or serial.portstr
+        self.rx_queue = rx_queue
+        self.on_items = on_items
+        self.frame_spacing = frame_spacing
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+        self.answer_inq = answer_inq
+        self.parser = insta.FrameParser()
+        self.rx = RxBuffer(serial.fileno())
+        self.txbuf = []
+        self.write_timer = None
+        self.idle_at = 0            # when the last write has left the UART
+        self.sends = deque()        # (telegram, callback, queued at) waiting for the handshake
+        self.current = None         # [telegram, callback, attempts, timer, queued at]
+        self.inq_at = None          # when the current INQ was queued
+        self.inq_sent = None        # and written
+        self.yielding = False       # our INQ crossed the transceiver's, waiting for its telegram
+        self.written = None         # (queued at, ACKed at) of the telegram in txbuf
+        self.metrics = metrics or DISABLED
+        self.tap = tap
+        self.duty = duty
+        self.duty_timer = None      # waiting for airtime before the next handshake
+        self.stall_timer = None     # the start of a telegram is held, see _stalled()
+        self.read_at = 0            # when the port was last read
+        self.closed = False
+        self.serial.timeout = 0     # reads return what is there, never block
+        self.fd = serial.fileno()
+        loop.add_reader(self.fd, self.readable)
+
+    def close(self):
+        """stop serving the port, pending and queued sends fail"""
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_reader(self.fd)
+        if self.write_timer is not None:
+            self.loop.cancel(self.write_timer)
+        if self.duty_timer is not None:
+            self.loop.cancel(self.duty_timer)
+        if self.stall_timer is not None:
+            self.loop.cancel(self.stall_timer)
+        del self.txbuf[:]
+        self.serial.close()
+        if self.current is not None:
+            self.loop.cancel(self.current[3])
+            self._done(False)
+        else:
+            self._fail_queued()
+
+    def _lost(self):
+        self.close()                # unplugged, leave the other ports running
+        if self.on_items is not None:
+            self.on_items(self, None)
+
+    def write(self, data):
+        """queue raw bytes, written together at the next allowed moment"""
+        self.txbuf.append(data)
+        if self.write_timer is None:
+            delay = self.idle_at + self.frame_spacing - time.time()
+            self.write_timer = self.loop.call_later(max(0, delay), self._flush)
+
+    def _flush(self):
+        self.write_timer = None
+        inq = self.current is not None and self.inq_sent is None
+        if inq:
+            # what came in before our INQ cannot answer it: read it now,
+            # stale ACKs are ignored while inq_sent is None (telegrams
+            # from other remotes are still delivered)
+            if select.select([self.fd], [], [], 0)[0]:
+                self.readable()
+                if self.closed:
+                    return
+        data = ''.join(self.txbuf)
+        del self.txbuf[:]
+        if data:
+            try:
+                self.serial.write(data)
+            except (serial.SerialException, IOError, OSError):
+                self._lost()
+                return
+            if self.tap is not None:
+                self.tap(TX, data)
+            now = time.time()
+            # 10 bits per byte on the wire, no need to block in tcdrain()
+            self.idle_at = now + len(data) * 10.0 / self.serial.baudrate
+            if inq:
+                self.inq_sent = self.metrics.since('inq_write', self.inq_at)
+            if self.written is not None:
+                self.metrics.since('telegram_write', self.written[1])
+                self.metrics.since('send', self.written[0])
+                self.written = None
+        if self.current is None:
+            self._next()            # the last telegram is out, start the next handshake
+
+    def send(self, telegram, callback=None):
+        """send a telegram after the transceiver ACKed an INQ. callback(ok)
+           is called with False when no ACK came after `retries` repeats."""
+        if self.closed:
+            if callback is not None:
+                callback(False)
+            return
+        self.sends.append((telegram, callback, time.time()))
+        self._next()
+
+    def _next(self):
+        # a telegram still in txbuf goes out first, _flush() starts the
+        # next handshake once it is written, frame_spacing later
+        if not self.sends or self.current is not None or self.duty_timer is not None or self.txbuf:
+            return
+        if self.duty is not None:
+            delay = self.duty.delay()
+            if delay > 0:
+                self.duty.waiting(delay)
+                self.duty_timer = self.loop.call_later(delay, self._airtime)
+                return
+        telegram, callback, queued = self.sends.popleft()
+        self.metrics.since('queue', queued)
+        self.current = [telegram, callback, 0, None, queued]
+        self._inq()
+
+    def _airtime(self):
+        self.duty_timer = None
+        self._next()
+
+    def _inq(self):
+        self.inq_at = time.time()
+        self.inq_sent = None
+        self.write(chr(insta.INQ))
+        self.current[3] = self.loop.call_later(self.ack_timeout, self._ack_timeout)
+
+    def _yield(self):
+        self.loop.cancel(self.current[3])
+        self.yielding = True
+        self.current[3] = self.loop.call_later(self.ack_timeout, self._resume)
+
+    def _resume(self):
+        self.yielding = False
+        self._inq()
+
+    def _ack_timeout(self):
+        self.metrics.count('ack_timeouts')
+        self.current[2] += 1
+        if self.current[2] > self.retries:
+            self._done(False)
+        else:
+            self._inq()
+
+    def _acked(self):
+        self.loop.cancel(self.current[3])
+        acked = self.metrics.since('ack', self.inq_sent)
+        self.written = (self.current[4], acked)
+        self.write(self.current[0])
+        if self.duty is not None:
+            self.duty.spend()
+        self._done(True)
+
+    def _done(self, ok):
+        callback = self.current[1]
+        self.current = None
+        self.yielding = False
+        if not ok:
+            self.metrics.count('failed_sends')
+        if callback is not None:
+            callback(ok)
+        if self.closed:
+            self._fail_queued()
+        else:
+            self._next()
+
+    def _fail_queued(self):
+        while self.sends:
+            callback = self.sends.popleft()[1]
+            if callback is not None:
+                callback(False)
+
+    def readable(self):
+        rx = self.rx
+        try:
+            n = rx.fill()
+        except (serial.SerialException, IOError, OSError):
+            self._lost()
+            return
+        if n is None:
+            return                  # woken up for nothing
+        if n == 0:
+            # select() said readable but there is no data: unplugged or
+            # hung up, pyserial's read() raised SerialException for this.
+            # (a tty with VMIN 0 also reads 0 when idle, so only call
+            # this when select() reported the fd)
+            self._lost()
+            return
+        if self.tap is not None:
+            self.tap(RX, str(rx.buf[rx.end - n:rx.end]))
+        now = self.read_at = time.time()
+        items, pos = self.parser.parse(rx.buf, rx.start, rx.end)
+        rx.consume(pos)
+        if rx.start < rx.end and self.stall_timer is None:
+            self.stall_timer = self.loop.call_later(STALL_TIMEOUT, self._stalled)
+        self._received(items, now)
+
+    def _stalled(self):
+        # a telegram comes in one piece, what stopped halfway was noise
+        # and may hold back an ACK
+        self.stall_timer = None
+        rx = self.rx
+        if rx.start == rx.end:
+            return
+        now = time.time()
+        if now - self.read_at < STALL_TIMEOUT:
+            self.stall_timer = self.loop.call_later(self.read_at + STALL_TIMEOUT - now, self._stalled)
+            return
+        items, pos = self.parser.parse(rx.buf, rx.start, rx.end, True)
+        rx.consume(pos)
+        self._received(items, now)
+
+    def _received(self, items, now):
+        for item in items:
+            if isinstance(item, insta.Frame):
+                if self.rx_queue is not None:
+                    self.rx_queue.publish((now, item))
+                if self.yielding and self.current is not None:
+                    self.loop.cancel(self.current[3])
+                    self._resume()
+            elif item.byte == insta.INQ:
+                if self.answer_inq:
+                    self.write(chr(insta.ACK) * 2)
+                    if self.current is not None and self.inq_sent is not None and not self.yielding:
+                        self._yield()
+            elif item.byte == insta.ACK:
+                # only an ACK after our INQ went out answers it
+                if self.current is not None and self.inq_sent is not None and not self.yielding:
+                    self._acked()
+        if self.on_items is not None:
+            self.on_items(self, items)
+
+
+class RawPort:
+    """a serial device without INSTA framing (e.g. a JeeNode) on a Loop.
+       every chunk read is passed to on_data(port, data); data is None once
+       the port went away. tap works as for InstaPort. `bench.py --only
+       jeenode` reads 1.3-1.8 MB/s of JeeNode lines through a pty (python
+       2.7, x86), a 57600 baud link carries 5.7 kB/s.
+    """
+    def __init__(self, loop, serial, on_data, name=None, tap=None):
+        self.tap = tap
+        self.loop = loop
+        self.serial = serial
+        self.name = name or serial.portstr
+        self.on_data = on_data
+        self.serial.timeout = 0
+        self.fd = serial.fileno()
+        loop.add_reader(self.fd, self.readable)
+
+    def close(self):
+        self.loop.remove_reader(self.fd)
+        self.serial.close()
+
+    def write(self, data):
+        self.serial.write(data)
+        if self.tap is not None:
+            self.tap(TX, data)
+
+    def readable(self):
+        try:
+            data = self.serial.read(self.serial.inWaiting() or 1)
+        except (serial.SerialException, IOError, OSError):
+            self.close()
+            self.on_data(self, None)
+            return
+        if data:
+            if self.tap is not None:
+                self.tap(RX, data)
+            self.on_data(self, data)
+
+
+class CommandServer:
+    """line based command socket on a Loop. every non-empty line received
+       on a connection is passed to handler(line, reply), reply(text) may be
+       called later; replies go back in the order the lines came in, one
+       line per request line. a reply of several lines (e.g. Prometheus
+       text) is sent as '+<number of lines>' followed by the lines, see
+       read_reply().
+    """
+    def __init__(self, loop, path, handler):
+        self.loop = loop
+        self.path = path
+        self.handler = handler
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(5)
+        self.sock.setblocking(0)
+        loop.add_reader(self.sock.fileno(), self._accept)
+
+    def _accept(self):
+        try:
+            conn, addr = self.sock.accept()
+        except socket.error:
+            return
+        _Connection(self, conn)
+
+    def close(self):
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        os.unlink(self.path)
+
+
+def read_reply(lines):
+    """the next reply from an iterator over the lines of a CommandServer
+       connection, several lines joined by newlines; None at the end"""
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line.startswith('+') and line[1:].isdigit():
+            return '\n'.join([next(lines).rstrip('\r\n') for i in range(int(line[1:]))])
+        return line.strip()
+    return None
+
+
+class _Connection:
+    def __init__(self, server, conn):
+        self.loop = server.loop
+        self.handler = server.handler
+        self.conn = conn
+        self.fd = conn.fileno()
+        self.inbuf = ''
+        self.outbuf = ''
+        self.replies = []           # one [text] slot per line, in order
+        self.eof = False
+        self.closed = False
+        conn.setblocking(0)
+        self.loop.add_reader(self.fd, self._readable)
+
+    def _readable(self):
+        try:
+            data = self.conn.recv(4096)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ''
+        if data:
+            self.inbuf += data
+            lines = self.inbuf.split('\n')
+            self.inbuf = lines.pop()
+        else:
+            self.eof = True
+            self.loop.remove_reader(self.fd)
+            lines = [self.inbuf]
+        for line in lines:
+            line = line.strip()
+            if line:
+                slot = [None]
+                self.replies.append(slot)
+                self.handler(line, self._replier(slot))
+        self._flush()
+
+    def _replier(self, slot):
+        def reply(text):
+            slot[0] = text
+            self._flush()
+        return reply
+
+    def _flush(self):
+        if self.closed:
+            return
+        while self.replies and self.replies[0][0] is not None:
+            text = self.replies.pop(0)[0]
+            if '\n' in text:
+                text = '+%d\n%s' % (text.count('\n') + 1, text)
+            self.outbuf += text + '\n'
+        if self.outbuf:
+            try:
+                n = self.conn.send(self.outbuf)
+                self.outbuf = self.outbuf[n:]
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.close()
+                    return
+        if self.outbuf:
+            self.loop.add_writer(self.fd, self._flush)
+        else:
+            self.loop.remove_writer(self.fd)
+            if self.eof and not self.replies:
+                self.close()
+
+    def close(self):
+        self.closed = True
+        self.loop.remove_reader(self.fd)
+        self.loop.remove_writer(self.fd)
+        self.conn.close()
@@ -0,0 +1,294 @@
+# Gateway for several INSTA transceivers and JeeNode receivers in one process
+#
+#  python gateway.py --config gateway.ini
+#
+# all ports are served by a single engine.Loop. commands arrive on the
+# unix socket used by `instasend.py --socket`, either as plain switch
+# commands ('a4on', routed by group) or addressed to a transceiver by
+# name ('east:a4on'), or 'stats' / 'metrics' for the send latencies of
+# all transceivers (with --metrics). commands waiting for a transceiver are
+# coalesced per switch, 'scheduled <command>' yields to manual commands and
+# a transceiver with a duty_cycle waits for airtime within it. with a state
+# cache, commands for a known state are answered at once ('force <command>'
+# sends anyway). everything received on any port is written to
+# stdout, one line per telegram or message, prefixed with time and port.
+# a port that goes away is reported and the others keep running, commands
+# for it are answered with "ERR <name> is closed".
+#
+# example configuration, one section per port:
+#
+#   [gateway]
+#   socket = /tmp/instasend.sock
+#   decoders = weather             # modules registering JeeNode decoders
+#   state_cache = /var/tmp/insta.state
+#   state_ttl = 600                # seconds a known state is trusted
+#
+#   [east]
+#   type = insta
+#   port = /dev/ttyUSB2
+#   groups = a, b
+#   duty_cycle = 0.1               # share of airtime allowed, no pacing if not given
+#   airtime = 0.05                 # seconds on the air per telegram, measure it
+#
+#   [west]
+#   type = insta
+#   port = /dev/ttyUSB3
+#   groups = c
+#
+#   [meter]
+#   type = jeenode
+#   port = /dev/ttyUSB0
+#   baudrate = 57600
+
+import sys, time, serial, ConfigParser
+import insta, engine, jeenode, scheduler, statecache
+from metrics import Metrics
+from dutycycle import DutyCycle, TELEGRAM_AIRTIME
+from insta import TELEGRAMS
+
+PORT_TYPES = ('insta', 'jeenode')
+DEFAULT_BAUDRATE = {'insta': 9600, 'jeenode': 57600}
+
+
+def prefixed(name, source):
+    """source() with the keys prefixed by the port name, for Metrics"""
+    def values():
+        return dict([("%s_%s" % (name, key), value) for key, value in source().items()])
+    return values
+
+
+class Gateway:
+    def __init__(self, loop, out=sys.stdout, metrics=None):
+        self.loop = loop
+        self.out = out
+        self.metrics = metrics or Metrics(enabled=False)
+        self.cache = None           # statecache.StateCache, see use_cache()
+        self.ports = {}             # name -> InstaPort/RawPort
+        self.routes = {}            # group letter -> InstaPort
+        self.schedulers = {}        # name -> Scheduler of an InstaPort
+        self.parsers = {}           # name -> JeeNodeParser of a RawPort
+        self.seqs = {}              # name -> SeqTracker of a RawPort
+
+    def add_insta(self, name, ser, groups=(), **kwargs):
+        port = engine.InstaPort(self.loop, ser, on_items=self.received, name=name,
+                                answer_inq=True, metrics=self.metrics, **kwargs)
+        self.ports[name] = port
+        self.schedulers[name] = scheduler.Scheduler(port)
+        self.metrics.add_counters(prefixed(name, self.schedulers[name].counters))
+        if port.duty is not None:
+            self.metrics.add_counters(prefixed(name, port.duty.counters))
+            self.metrics.add_gauges(prefixed(name, port.duty.gauges))
+        for group in groups:
+            if group in self.routes:
+                raise ValueError("group %r is routed to both %s and %s" % (
+                    group, self.routes[group].name, name))
+            self.routes[group] = port
+        return port
+
+    def use_cache(self, cache):
+        self.cache = cache
+        self.metrics.add_counters(cache.counters)
+
+    def save_cache(self):
+        try:
+            self.cache.save()
+        except (IOError, OSError), e:
+            sys.stderr.write("could not save the state cache: %s\n" % e)
+
+    def add_jeenode(self, name, ser):
+        port = engine.RawPort(self.loop, ser, self.received_jeenode, name=name)
+        self.parsers[name] = jeenode.JeeNodeParser()
+        self.seqs[name] = jeenode.SeqTracker()
+        self.ports[name] = port
+        return port
+
+    def route(self, cmd):
+        """(port, telegram) for 'a4on' or 'east:a4on', raises ValueError"""
+        name, sep, switch = cmd.lower().rpartition(':')
+        telegram = TELEGRAMS.get(switch)
+        if telegram is None:
+            raise ValueError("invalid command %r" % cmd)
+        if name:
+            port = self.ports.get(name)
+        else:
+            port = self.routes.get(switch[0])
+        if not isinstance(port, engine.InstaPort):
+            raise ValueError("no transceiver for %r" % cmd)
+        if port.closed:
+            raise ValueError("%s is closed" % port.name)
+        return port, telegram
+
+    def handle(self, cmd, reply):
+        if cmd == 'stats':
+            reply(self.metrics.json())
+            return
+        if cmd == 'metrics':
+            reply(self.metrics.prometheus())
+            return
+        force, cmd = statecache.parse_force(cmd)
+        priority, cmd = scheduler.parse_priority(cmd)
+        try:
+            port, telegram = self.route(cmd)
+        except ValueError, e:
+            reply("ERR %s" % e)
+            return
+        cache = self.cache
+        if cache is not None:
+            if not force and cache.known(telegram):
+                reply("OK")
+                return
+            cache.submitted(telegram)
+        def sent(ok):
+            if cache is not None:
+                cache.update(telegram, ok)
+                self.save_cache()
+            if ok:
+                reply("OK")
+            elif port.closed:
+                reply("ERR %s is closed" % port.name)
+            else:
+                reply("ERR no ACK from %s" % port.name)
+        self.schedulers[port.name].submit(telegram, sent, priority)
+
+    def write(self, name, text):
+        self.out.write("%.3f %s: %s\n" % (time.time(), name, text))
+        self.out.flush()
+
+    def lost(self, port):
+        """the other ports keep running, commands for this one get an error"""
+        self.write(port.name, "port closed")
+        sys.stderr.write("port %s lost\n" % port.name)
+
+    def received(self, port, items):
+        if items is None:
+            self.lost(port)
+            return
+        for item in items:
+            if isinstance(item, insta.Frame):
+                self.write(port.name, insta.describe(item))
+                if self.cache is not None:
+                    self.cache.received(item)
+        if self.cache is not None:
+            self.save_cache()
+
+    def received_jeenode(self, port, data):
+        if data is None:
+            self.lost(port)
+            return
+        seqs = self.seqs[port.name]
+        for record in self.parsers[port.name].feed(data):
+            if hasattr(record, 'seq') and not seqs.check(record):
+                continue
+            self.write(port.name, jeenode.describe(record))
+
+
+def load(gateway, filename):
+    """open the ports configured in `filename`, returns the socket path"""
+    config = ConfigParser.SafeConfigParser()
+    if not config.read(filename):
+        raise ValueError("could not read %s" % filename)
+    path = None
+    if config.has_section('gateway') and config.has_option('gateway', 'socket'):
+        path = config.get('gateway', 'socket')
+    if config.has_section('gateway') and config.has_option('gateway', 'decoders'):
+        jeenode.import_decoders(config.get('gateway', 'decoders').replace(',', ' ').split())
+    if config.has_section('gateway') and config.has_option('gateway', 'state_cache'):
+        ttl = statecache.TTL
+        if config.has_option('gateway', 'state_ttl'):
+            ttl = config.getfloat('gateway', 'state_ttl')
+        try:
+            gateway.use_cache(statecache.StateCache(config.get('gateway', 'state_cache'), ttl))
+        except IOError, e:
+            raise ValueError("could not read the state cache: %s" % e)
+    for section in config.sections():
+        if section == 'gateway':
+            continue
+        name = section.lower()
+        kind = config.get(section, 'type') if config.has_option(section, 'type') else 'insta'
+        if kind not in PORT_TYPES:
+            raise ValueError("[%s]: unknown type %r" % (section, kind))
+        baudrate = DEFAULT_BAUDRATE[kind]
+        if config.has_option(section, 'baudrate'):
+            baudrate = config.getint(section, 'baudrate')
+        ser = serial.Serial(config.get(section, 'port'), baudrate, timeout=0)
+        if kind == 'insta':
+            groups = []
+            if config.has_option(section, 'groups'):
+                groups = config.get(section, 'groups').replace(',', ' ').split()
+            duty_cycle = 0.0
+            if config.has_option(section, 'duty_cycle'):
+                duty_cycle = config.getfloat(section, 'duty_cycle')
+            airtime = TELEGRAM_AIRTIME
+            if config.has_option(section, 'airtime'):
+                airtime = config.getfloat(section, 'airtime')
+            duty = None
+            if duty_cycle:
+                try:
+                    duty = DutyCycle(duty_cycle, airtime)
+                except ValueError, e:
+                    raise ValueError("[%s]: %s" % (section, e))
+            gateway.add_insta(name, ser, groups, duty=duty)
+        else:
+            gateway.add_jeenode(name, ser)
+    return path
+
+
+def main():
+    import optparse
+
+    parser = optparse.OptionParser(
+        usage = "%prog [options]",
+        description = "Gateway - serve several INSTA transceivers and JeeNode receivers from one process."
+    )
+
+    parser.add_option("-C", "--config",
+        dest = "config",
+        help = "configuration file with one section per port",
+        default = "gateway.ini"
+    )
+
+    parser.add_option("-s", "--socket",
+        dest = "socket",
+        help = "unix socket for commands, overrides the configuration file",
+        default = None
+    )
+
+    parser.add_option("--metrics",
+        dest = "metrics",
+        action = "store_true",
+        help = "time the phases of every send, served as 'stats' and 'metrics' on the socket",
+        default = False
+    )
+
+    (options, args) = parser.parse_args()
+
+    loop = engine.Loop()
+    gateway = Gateway(loop, metrics=Metrics(enabled=options.metrics))
+    try:
+        path = load(gateway, options.config)
+    except (ValueError, ImportError, ConfigParser.Error), e:
+        parser.error(str(e))
+    except serial.SerialException, e:
+        sys.stderr.write("could not open port: %s\n" % e)
+        sys.exit(1)
+    path = options.socket or path
+    if path is None:
+        parser.error("no command socket configured")
+
+    sys.stderr.write("--- Gateway on %s: %s ---\n" % (path, ', '.join(sorted(gateway.ports))))
+    server = engine.CommandServer(loop, path, gateway.handle)
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        pass
+    server.close()
+    for name, seqs in sorted(gateway.seqs.items()):
+        for line in seqs.describe():
+            sys.stderr.write("--- %s: %s\n" % (name, line))
+    for name, port in sorted(gateway.ports.items()):
+        if getattr(port, 'duty', None) is not None:
+            sys.stderr.write("--- %s: %s\n" % (name, port.duty.describe()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+# INSTA radio protocol: telegram framing, encoding and decoding
+# shared by instasend.py and jungsend.py
+#
+# a telegram is 12 bytes:
+#   0x55 <type> <8 data bytes> <checksum> 0xAA
+# the checksum makes the sum of the first 11 bytes a multiple of 256.
+# outside of telegrams the transceiver talks in single INQ/ACK bytes.
+
+import struct
+from collections import namedtuple
+
+INQ = 0xfa
+ACK = 0x05
+
+START = 0x55
+END = 0xaa
+
+TYPE_SWITCH = 0x16
+TYPE_VERSION = 0x32
+TYPES = (TYPE_SWITCH, TYPE_VERSION)     # the telegrams we know, others are counted
+
+FRAME = struct.Struct('<BB8sBB')    # start, type, data, checksum, end
+FRAME_LEN = FRAME.size
+DATA_LEN = 8
+
+Frame = namedtuple('Frame', 'type data')
+Control = namedtuple('Control', 'byte')     # a byte received outside a telegram
+
+
+class ChecksumError(ValueError):
+    pass
+
+
+def checksum(header):
+    """checksum byte for the first 10 bytes of a telegram"""
+    return -sum(bytearray(header)) & 0xff
+
+
+def encode_frame(type, data):
+    """build a complete telegram from its type and 8 data bytes"""
+    if len(data) != DATA_LEN:
+        raise ValueError("telegram data must be %d bytes, not %d" % (DATA_LEN, len(data)))
+    header = chr(START) + chr(type) + data
+    return header + chr(checksum(header)) + chr(END)
+
+
+def decode_frame(buf, offset=0):
+    """decode the telegram at buf[offset:offset+12] (str, bytearray or
+       memoryview). raises ValueError if it is not framed correctly and
+       ChecksumError if the checksum does not match.
+    """
+    start, type, data, crc, end = FRAME.unpack_from(buf, offset)
+    if start != START or end != END:
+        raise ValueError("not an INSTA telegram")
+    if sum(bytearray(buf[offset:offset + FRAME_LEN - 1])) & 0xff:
+        raise ChecksumError("bad checksum 0x%02x" % crc)
+    return Frame(type, data)
+
+
+# device byte of a switch telegram: group and channel select the receiver,
+# bit 6/7 switch it on/off
+GROUPS = {'a': 0x00, 'b': 0x08, 'c': 0x10}
+CHANNELS = range(1, 9)
+ACTIONS = {'on': 0x40, 'off': 0x80}
+
+def build_telegram(group, channel, action):
+    """return the 12 byte switch telegram, e.g. build_telegram('a', 4, 'on')"""
+    if group not in GROUPS or channel not in CHANNELS or action not in ACTIONS:
+        raise ValueError("no such INSTA switch: %r %r %r" % (group, channel, action))
+    device = GROUPS[group] | (channel - 1) | ACTIONS[action]
+    return encode_frame(TYPE_SWITCH, '\x00' + chr(device) + '\x01\x00\x00\x00\x00\x00')
+
+def decode_switch(frame):
+    """(group, channel, action) of a switch telegram, action is None when
+       the device byte has neither the on nor the off bit set. raises
+       ValueError for group bits that name no group.
+    """
+    if frame.type != TYPE_SWITCH:
+        raise ValueError("not a switch telegram (type 0x%02x)" % frame.type)
+    device = ord(frame.data[1])
+    bits = (device >> 3) & 0x03
+    if bits >= len('abc'):
+        raise ValueError("unknown group bits in device byte 0x%02x" % device)
+    group = 'abc'[bits]
+    channel = (device & 0x07) + 1
+    action = None
+    for name, bit in ACTIONS.items():
+        if device & bit:
+            action = name
+    return group, channel, action
+
+def describe(frame):
+    """one line, human readable description of a telegram"""
+    if frame.type == TYPE_SWITCH:
+        try:
+            group, channel, action = decode_switch(frame)
+            return "switch %s%d %s" % (group, channel, action or '?')
+        except ValueError:
+            pass                    # someone else's device byte, show the bytes
+    return "telegram type 0x%02x: %s" % (frame.type,
+        ' '.join(['%02x' % b for b in bytearray(frame.data)]))
+
+# every possible command ('a1on' .. 'c8off') -> ready to write telegram
+TELEGRAMS = dict([('%s%d%s' % (g, c, a), build_telegram(g, c, a))
+                  for g in GROUPS for c in CHANNELS for a in ACTIONS])
+
+VERSION_QUERY = encode_frame(TYPE_VERSION, '\xcd\xf1\xfa\x00\x00\x00\x00\x00')
+
+
+# one Control per byte value, so parsing control bytes allocates nothing
+CONTROLS = [Control(byte) for byte in range(256)]
+
+
+class FrameParser:
+    """incremental decoder for the received byte stream.
+
+       feed() takes chunks of any size and returns the Frame and Control
+       items completed by it. bytes that only look like the start of a
+       telegram (bad terminator or checksum) are counted in `errors` and
+       handed out as Control items, so the parser resyncs on the next 0x55.
+       telegrams of a type not in TYPES are handed out as well and counted
+       in `unknown`.
+
+       a stray 0x55 must not hold back the ACKs behind it: one followed by
+       INQ or ACK is taken as noise at once, and flush() hands out the
+       start of a telegram that stopped halfway (call it when the line has
+       been quiet for longer than a telegram takes).
+
+       parse() does the same in place on a caller's bytearray (the receive
+       buffer of engine.InstaPort) and keeps no data of its own.
+    """
+    def __init__(self):
+        self.buf = bytearray()
+        self.errors = 0
+        self.unknown = 0
+
+    def feed(self, data):
+        buf = self.buf
+        buf.extend(data)
+        items, pos = self.parse(buf, 0, len(buf))
+        del buf[:pos]
+        return items
+
+    def flush(self):
+        """the held start of a telegram as Control items"""
+        items, pos = self.parse(self.buf, 0, len(self.buf), True)
+        del self.buf[:pos]
+        return items
+
+    def parse(self, buf, pos, n, stalled=False):
+        """decode buf[pos:n], returns (items, position of the first byte
+           not consumed, i.e. the start of an incomplete telegram). with
+           `stalled` an incomplete telegram is not waited for."""
+        items = []
+        start_byte = chr(START)
+        while pos < n:
+            start = buf.find(start_byte, pos, n)
+            if start < 0:
+                start = n
+            for i in xrange(pos, start):
+                items.append(CONTROLS[buf[i]])
+            pos = start
+            if pos == n:
+                break
+            if n - pos < FRAME_LEN:
+                if not stalled and not (n - pos > 1 and buf[pos + 1] in (INQ, ACK)):
+                    break               # wait for the rest of the telegram
+                self.errors += 1
+                items.append(CONTROLS[START])
+                pos += 1
+                continue
+            try:
+                frame = decode_frame(buf, pos)
+            except ValueError:
+                self.errors += 1
+                items.append(CONTROLS[START])
+                pos += 1
+                continue
+            if frame.type not in TYPES:
+                self.unknown += 1
+            items.append(frame)
+            pos += FRAME_LEN
+        return items, pos
@@ -3,9 +3,35 @@
 # Based on miniterm.py by Chris Liechti <cliechti@gmx.net>
 
 #  python instasend.py --port /dev/ttyUSB2 -c a4on
-
-
-import sys, os, serial, threading, array, time
+#  python instasend.py --port /dev/ttyUSB2 -c a1on,a2on,b3off
+#  python instasend.py --port /dev/ttyUSB2 -f scene.txt     (- for stdin)
+#
+#  or keep the port open in a daemon and use the thin client:
+#  python instasend.py --port /dev/ttyUSB2 --daemon --socket /tmp/instasend.sock
+#  python instasend.py --socket /tmp/instasend.sock -c a4on
+#  python instasend.py --socket /tmp/instasend.sock --scheduled -c a4off    (automation, yields to manual commands)
+#  python instasend.py --socket /tmp/instasend.sock -c metrics      (or stats for JSON)
+#
+# with --duty-cycle (e.g. 0.01) telegrams are paced to the duty cycle of
+# the band: a batch goes out at full speed while there is airtime left,
+# then waits for it. measure --airtime first. one-shot runs only share the
+# budget through --duty-state FILE, without it each run starts afresh.
+#
+# with --state-cache FILE a command that sets a switch to the state it was
+# given less than --state-ttl seconds ago is answered without the radio,
+# --force sends it anyway (see statecache.py).
+
+
+import time
+STARTED = time.time()           # for the startup phase of --metrics
+
+# only what the one-shot path needs is imported here, the daemon, client
+# and keyboard pieces import theirs when they are used
+import sys, os, select, serial
+from insta import INQ, ACK, TELEGRAMS, Frame
+from metrics import Metrics
+from dutycycle import DutyCycle, TELEGRAM_AIRTIME
+import scheduler, statecache
 
 EXITCHARCTER = '\x1d'   # GS/CTRL+]
 MENUCHARACTER = '\x14'  # Menu: CTRL+T
@@ -59,8 +85,10 @@ def get_help_text():
     'exchar': key_description(EXITCHARCTER),
 }
 
-# first choose a platform dependant way to read single characters from the console
-global console
+# first choose a platform dependant way to read single characters from the console.
+# the terminal is left alone until setup_console() is called for interactive
+# use, importing this module has no side effects
+console = None
 
 if os.name == 'nt':
     import msvcrt
@@ -84,10 +112,8 @@ if os.name == 'nt':
                         return '\n'
                     return z
 
-    console = Console()
-
 elif os.name == 'posix':
-    import termios, sys, os
+    import termios
     class Console:
         def __init__(self):
             self.fd = sys.stdin.fileno()
@@ -108,16 +134,20 @@ elif os.name == 'posix':
         def cleanup(self):
             termios.tcsetattr(self.fd, termios.TCSAFLUSH, self.old)
 
-    console = Console()
 
-    def cleanup_console():
-        console.cleanup()
+def cleanup_console():
+    console.cleanup()
 
-    console.setup()
-    sys.exitfunc = cleanup_console      #terminal modes have to be restored on exit...
-
-else:
-    raise "Sorry no implementation for your platform (%s) available." % sys.platform
+def setup_console():
+    """switch the terminal on stdin to single key input, restored at exit"""
+    global console
+    if console is None:
+        if os.name not in ('nt', 'posix'):
+            raise RuntimeError("Sorry no implementation for your platform (%s) available." % sys.platform)
+        console = Console()
+        console.setup()
+        sys.exitfunc = cleanup_console      #terminal modes have to be restored on exit...
+    return console
 
 
 CONVERT_CRLF = 2
@@ -128,13 +158,27 @@ LF_MODES = ('LF', 'CR', 'CR/LF')
 
 REPR_MODES = ('raw', 'some control', 'all control', 'hex')
 
-INQ = 0xfa
-ACK = 0x05
 CRLF = '\r\n' 
 
 class Miniterm:
-    def __init__(self, port, baudrate, cmd, echo=False, convert_outgoing=CONVERT_CRLF, repr_mode=0):
+    def __init__(self, port, baudrate, cmd, echo=False, convert_outgoing=CONVERT_CRLF, repr_mode=0, ack_timeout=0.5, retries=2, metrics=None, coalesce=True, duty=None, cache=None, force=False):
+        self.metrics = metrics or Metrics(enabled=False)
+        self.coalesce = coalesce
+        self.duty = duty
+        self.cache = cache
+        self.force = force
+        self.known = 0              # commands answered from the state cache
+        if cache is not None:
+            self.metrics.add_counters(cache.counters)
+        if duty is not None:
+            self.metrics.add_counters(duty.counters)
+            self.metrics.add_gauges(duty.gauges)
+        self.saved = 0
+        t = self.metrics.since('startup', STARTED)
         self.serial = serial.Serial(port, baudrate, parity='N', rtscts=False, xonxoff=False, timeout=0.7)
+        self.metrics.since('port_open', t)
+        self.ack_timeout = ack_timeout
+        self.retries = retries
 
         self.echo = echo
         self.repr_mode = repr_mode
@@ -147,114 +191,138 @@ class Miniterm:
     def start(self):
         self.alive = True
 
-        # enter keyboard handling loop
-        self.keyboard_thread = threading.Thread(target=self.keyb)
-        self.keyboard_thread.setDaemon(1)
-        self.keyboard_thread.start()
+        # enter keyboard handling loop, commands may be piped in on stdin
+        if sys.stdin.isatty():
+            import threading
+            setup_console()
+            self.keyboard_thread = threading.Thread(target=self.keyb)
+            self.keyboard_thread.setDaemon(1)
+            self.keyboard_thread.start()
+
+        # Send INSTA command(s)
+        self.sent = self.send_batch(self.cmd)
+        if self.cache is not None:
+            try:
+                self.cache.save()
+            except (IOError, OSError), e:
+                sys.stderr.write("could not save the state cache: %s\n" % e)
+
+    def send_batch(self, cmds):
+        """send several commands in one session on the already open port.
+           with `coalesce` set only the last state given to a switch is
+           sent (a4on,a4off,a4on sends a4on once). returns the number of
+           commands that were ACKed and written or merged into one that was.
+        """
+        plan = [(cmd, 1) for cmd in cmds]
+        if self.coalesce:
+            plan = scheduler.coalesce(cmds)
+        self.saved += len(cmds) - len(plan)
+        sent = 0
+        for cmd, merged in plan:
+            try:
+                if self.send(cmd):
+                    sent += merged
+                else:
+                    sys.stderr.write("no ACK for %s\n" % cmd)
+            except ValueError:
+                sys.stderr.write("invalid command %r\n" % cmd)
+        return sent
 
-        # Send INSTA command        
-        cmd = self.cmd.lower()
+    def send(self, cmd):
+        """send one INSTA command (e.g. 'a4on') over the already open port.
+           returns True if the transceiver ACKed and the telegram was written.
+        """
+        cmd = cmd.lower()
         if self.echo:
             sys.stdout.write("cmd:%s\n" % cmd)
             sys.stdout.write("cmd len:%d\n" % len(cmd))
 
-        telegram = '\x55\x16\x00'
-        device = 0;
-        
-        # add group #
-        if cmd[0] == 'a':
-            device = 0x00
-        elif cmd[0] == 'b':
-            device = 0x08
-        elif cmd[0] == 'c':
-            device = 0x10
-
-        # Add channel #
-        channel = int(cmd[1])
-  #      sys.stdout.write("channel:%d\n" % channel)
-        device = device | (channel - 1)
-
-        # Add on/off
-        if cmd[2:4] == "on":
-            device = device | 0x40
-        elif cmd [2:5] == "off":
-            device = device | 0x80
-
-  #      sys.stdout.write("device:%x\n" % device)
-           
-            
-        telegram = telegram + chr(device) + '\x01\x00\x00\x00\x00\x00'
-        
-        sum = 0
-        for i in range(0, len(telegram)):
-            sum = sum + ord(telegram[i])
-#            sys.stdout.write("i=%d, %x\n" % (i, ord(telegram[i])))
-            
- #       sys.stdout.write("sum is:%x\n" % sum)
-        sum = sum & 0xff
- #       sys.stdout.write("sum2 is:%x\n" % sum)
-        crc = 2**8 - sum
- #       sys.stdout.write("CRC is:%x\n" % crc)
-
-        telegram = telegram + chr(crc) + '\xaa'
-
-        
-        if self.echo:
-            sys.stdout.write("INQ\n")
-        self.serial.write(chr(INQ))
-        while self.serial.inWaiting() == 0:
-            pass
-            
-        if self.serial.inWaiting() > 0:
-            data = self.serial.read(1)
+        telegram = TELEGRAMS.get(cmd)
+        if telegram is None:
+            raise ValueError("invalid command %r" % cmd)
+
+        if self.cache is not None and not self.force and self.cache.known(telegram):
+            self.known += 1
+            if self.echo:
+                sys.stdout.write("%s is known, not sent\n" % cmd)
+            return True
+
+        # handshake: INQ -> wait for ACK (bounded) -> telegram, retried
+        # a few times before giving up on a silent transceiver
+        metrics = self.metrics
+        start = time.time()
+        if self.duty is not None:
+            delay = self.duty.delay()
+            if delay > 0:
+                if self.echo:
+                    sys.stdout.write("waiting %.1fs for airtime\n" % delay)
+                self.duty.waiting(delay)
+                time.sleep(delay)
+        self.serial.flushInput()
+        for attempt in range(self.retries + 1):
+            if self.echo:
+                sys.stdout.write("INQ\n")
+            t = time.time()
+            self.serial.write(chr(INQ))
+            t = metrics.since('inq_write', t)
+            if self.wait_for(ACK, self.ack_timeout):
+                t = metrics.since('ack', t)
+                break
+            metrics.count('ack_timeouts')
+            if self.echo:
+                sys.stdout.write("no ACK within %.2fs\n" % self.ack_timeout)
+        else:
+            metrics.count('failed_sends')
+            if self.cache is not None:
+                self.cache.update(telegram, False)
+            return False
 
-#            sys.stdout.write("\\x%s " % data.encode('hex'))
-            if data == chr(ACK):
-                try:
-                    if self.echo:
-                        sys.stdout.write("ACK\n")
-#                    telegram = '\x55\x16\x00\x42\x01\x00\x00\x00\x00\x00\x52\xaa'
+        try:
+            if self.echo:
+                sys.stdout.write("ACK\n")
 # version query
-#                    telegram = "\x55\x32\xcd\xf1\xfa\x00\x00\x00\x00\x00\xc1\xaa"
-                    self.serial.write(telegram)
-                    self.serial.flush()
+#            telegram = "\x55\x32\xcd\xf1\xfa\x00\x00\x00\x00\x00\xc1\xaa"
+            self.serial.write(telegram)
+            if self.duty is not None:
+                self.duty.spend()
+            if self.cache is not None:
+                self.cache.update(telegram)
+            t = metrics.since('telegram_write', t)
+            self.serial.flush()
+            t = metrics.since('flush', t)
+            metrics.observe('send', t - start)
+
+            if self.echo:
+                for i in range(0, len(telegram)):
+                    sys.stdout.write("i=%d, \\x%x\n" % (i, ord(telegram[i])))
+            sys.stdout.flush()
+        except:
+            print "Serial write exception"
+            raise
+        return True
+
+    def wait_for(self, byte, timeout):
+        """block until `byte` is received or `timeout` seconds have passed.
+           sleeps in select() on the port instead of polling inWaiting().
+           other bytes received in the meantime are discarded.
+        """
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if os.name == 'posix':
+                readable, w, x = select.select([self.serial.fileno()], [], [], remaining)
+                if not readable:
+                    return False
+                data = self.serial.read(self.serial.inWaiting() or 1)
+            else:
+                self.serial.timeout = remaining
+                data = self.serial.read(1)
+            if chr(byte) in data:
+                return True
+
 
-                    if self.echo:
-                        for i in range(0, len(telegram)):
-                            sys.stdout.write("i=%d, \\x%x\n" % (i, ord(telegram[i])))
-                    sys.stdout.flush()
-
-#                    while self.serial.inWaiting() == 0:
-#                        pass
-
-#                    sys.stdout.write("Response:")
-#                    while self.serial.inWaiting() > 0:
-#                        data = self.serial.read(1)
-#                        sys.stdout.write("\\x%s " % data.encode('hex'))
-#                    sys.stdout.write("\n\n")
-#                    if data == chr(INQ):
-#                        sys.stdout.write("Received INQ\n")
-#                        self.serial.write(chr(ACK))
-#                        self.serial.flush()
-#                        sys.stdout.write("Sending ACK\n")
-                        
-#                        i = 1
-#                        while self.serial.inWaiting() == 0:
-#                            pass
-#                        while self.serial.inWaiting() > 0:
-#                            data = self.serial.read(1)
-#                            sys.stdout.write("%d:\\x%s " % (i, data.encode('hex')))
-#                            i=i+1
-#                            sys.stdout.write("\n")
-#                        sys.stdout.write("\n")
-
-                except:
-                    print "Serial write exception"
-                    raise
-    
-        
-        
-        
     def stop(self):
         self.alive = False
 
@@ -298,7 +366,124 @@ class Miniterm:
         except:
             self.alive = False
             raise
-      
+
+
+def serve(miniterm, path):
+    """own the serial port and execute commands received on a unix socket.
+       clients send one command per line and get "OK" or "ERR <reason>" back.
+       the port and all client connections are served by one engine.Loop.
+       commands waiting for the radio are coalesced by a scheduler.Scheduler,
+       lines starting with 'scheduled ' wait for the manual ones. with a
+       state cache, known states are answered at once unless the line
+       starts with 'force '. runs until SIGTERM or the port goes away,
+       returns False in that case.
+    """
+    import engine, signal
+    cache = miniterm.cache
+    lost = []
+    def save():
+        if cache is None:
+            return
+        try:
+            cache.save()
+        except (IOError, OSError), e:
+            sys.stderr.write("could not save the state cache: %s\n" % e)
+    def received(port, items):
+        if items is None:
+            sys.stderr.write("port %s lost\n" % miniterm.serial.portstr)
+            lost.append(port)
+            loop.stop()
+            return
+        if cache is None:
+            return
+        for item in items:
+            if isinstance(item, Frame):
+                cache.received(item)
+        save()
+    loop = engine.Loop()
+    port = engine.InstaPort(loop, miniterm.serial, ack_timeout=miniterm.ack_timeout,
+                            retries=miniterm.retries, metrics=miniterm.metrics, answer_inq=True,
+                            duty=miniterm.duty, on_items=received)
+    if miniterm.coalesce:
+        port = scheduler.Scheduler(port)
+        miniterm.metrics.add_counters(port.counters)
+
+    def handle(cmd, reply):
+        if cmd == 'stats':
+            reply(miniterm.metrics.json())
+            return
+        if cmd == 'metrics':
+            reply(miniterm.metrics.prometheus())
+            return
+        force, cmd = statecache.parse_force(cmd)
+        priority, cmd = scheduler.parse_priority(cmd)
+        telegram = TELEGRAMS.get(cmd.lower())
+        if telegram is None:
+            reply("ERR invalid command %r" % cmd)
+            return
+        if cache is not None:
+            if not force and not miniterm.force and cache.known(telegram):
+                reply("OK")
+                return
+            cache.submitted(telegram)
+        def sent(ok):
+            if cache is not None:
+                cache.update(telegram, ok)
+                save()
+            if ok:
+                reply("OK")
+            else:
+                reply("ERR no ACK")
+        if miniterm.coalesce:
+            port.submit(telegram, sent, priority)
+        else:
+            port.send(telegram, sent)
+
+    server = engine.CommandServer(loop, path, handle)
+    signal.signal(signal.SIGTERM, lambda signum, frame: loop.stop())
+    try:
+        loop.run()
+    finally:
+        server.close()
+        save()
+    return not lost
+
+
+def client_send(path, cmds):
+    """hand commands to a running daemon, returns its reply per command"""
+    import socket, engine
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(path)
+    try:
+        s.sendall(''.join([cmd + '\n' for cmd in cmds]))
+        s.shutdown(socket.SHUT_WR)
+        lines = iter(s.makefile('r'))
+        replies = list(iter(lambda: engine.read_reply(lines), None))
+    finally:
+        s.close()
+    return replies
+
+
+def read_commands(cmd, filename=None):
+    """collect commands from a -c list ("a1on,a2on b3off") and an optional
+       file with one or more commands per line ('-' reads stdin, # comments)
+    """
+    cmds = cmd.replace(',', ' ').split()
+    if filename is not None:
+        if filename == '-':
+            f = sys.stdin
+        else:
+            f = open(filename)
+        for line in f:
+            cmds.extend(line.split('#')[0].replace(',', ' ').split())
+        if f is not sys.stdin:
+            f.close()
+    return cmds
+
+
+def report_throughput(sent, total, elapsed):
+    sys.stderr.write("--- sent %d/%d commands in %.3fs (%.1f commands/s) ---\n" % (
+        sent, total, elapsed, sent / max(elapsed, 1e-6)))
 
 
 def main():
@@ -311,10 +496,16 @@ def main():
 
     parser.add_option("-c", "--cmd",
         dest = "cmd",
-        help ="command to send to INSTA transciever",
+        help ="command(s) to send to INSTA transciever, comma separated",
         default = ""
     )
 
+    parser.add_option("-f", "--file",
+        dest = "file",
+        help = "read commands from file, one or more per line (- for stdin)",
+        default = None
+    )
+
     parser.add_option("-p", "--port",
         dest = "port",
         help = "port, a number (default 0) or a device name (deprecated option)",
@@ -329,6 +520,99 @@ def main():
         default = 9600
     )
 
+    parser.add_option("-d", "--daemon",
+        dest = "daemon",
+        action = "store_true",
+        help = "keep the port open and serve commands on the unix socket given by --socket",
+        default = False
+    )
+
+    parser.add_option("-s", "--socket",
+        dest = "socket",
+        help = "unix socket of the daemon. without --daemon, the command is handed to the daemon listening there",
+        default = None
+    )
+
+    parser.add_option("--ack-timeout",
+        dest = "ack_timeout",
+        action = "store",
+        type = 'float',
+        help = "seconds to wait for the transceiver to ACK an INQ, default %default",
+        default = 0.5
+    )
+
+    parser.add_option("--retries",
+        dest = "retries",
+        action = "store",
+        type = 'int',
+        help = "number of times INQ is repeated when no ACK arrives, default %default",
+        default = 2
+    )
+
+    parser.add_option("--no-coalesce",
+        dest = "coalesce",
+        action = "store_false",
+        help = "send every command, even when a later one sets the same switch",
+        default = True
+    )
+
+    parser.add_option("--scheduled",
+        dest = "scheduled",
+        action = "store_true",
+        help = "with --socket, mark the commands as scheduled: the daemon sends manual commands first",
+        default = False
+    )
+
+    parser.add_option("--state-cache",
+        dest = "state_cache",
+        help = "file with the last state sent to each switch. commands for a state that is known are answered without the radio",
+        default = None
+    )
+
+    parser.add_option("--state-ttl",
+        dest = "state_ttl",
+        action = "store",
+        type = 'float',
+        help = "seconds a state in the cache is trusted. only the daemon hears changes made with other remotes, one-shot runs rely on this alone. default %default",
+        default = statecache.TTL
+    )
+
+    parser.add_option("--force",
+        dest = "force",
+        action = "store_true",
+        help = "send even when the state cache (of this run or of the daemon) knows the state",
+        default = False
+    )
+
+    parser.add_option("--duty-cycle",
+        dest = "duty_cycle",
+        action = "store",
+        type = 'float',
+        help = "share of the time the transceiver may be on the air per hour (e.g. 0.01), telegrams wait for airtime beyond that. default %default: no pacing",
+        default = 0.0
+    )
+
+    parser.add_option("--airtime",
+        dest = "airtime",
+        action = "store",
+        type = 'float',
+        help = "seconds on the air per telegram, default %default",
+        default = TELEGRAM_AIRTIME
+    )
+
+    parser.add_option("--duty-state",
+        dest = "duty_state",
+        help = "file keeping the airtime budget between runs, so one-shot runs are paced together",
+        default = None
+    )
+
+    parser.add_option("--metrics",
+        dest = "metrics",
+        action = "store_true",
+        help = "time the phases of every send. the daemon answers 'stats' (JSON) and 'metrics' (Prometheus text), otherwise a summary is printed at exit",
+        default = False
+    )
+
     parser.add_option("-e", "--echo",
         dest = "echo",
         action = "store_true",
@@ -390,9 +674,45 @@ def main():
     if options.cr and options.lf:
         parser.error("only one of --cr or --lf can be specified")
 
-    if options.cmd is "":
+    if options.daemon and options.socket is None:
+        parser.error('--daemon needs --socket')
+
+    try:
+        cmds = read_commands(options.cmd, options.file)
+    except IOError, e:
+        parser.error("could not read commands: %s" % e)
+
+    if not cmds and not options.daemon:
         parser.error('Must provide command')
 
+    if options.socket is not None and not options.daemon:
+        import socket
+        t = time.time()
+        try:
+            prefix = ''
+            if options.force:
+                prefix += statecache.FORCE + ' '
+            if options.scheduled:
+                prefix += 'scheduled '
+            if cmds in (['stats'], ['metrics']):
+                prefix = ''
+            replies = client_send(options.socket, [prefix + cmd for cmd in cmds])
+        except socket.error, e:
+            sys.stderr.write("could not reach daemon on %r: %s\n" % (options.socket, e))
+            sys.exit(1)
+        elapsed = time.time() - t
+        if cmds in (['stats'], ['metrics']):
+            sys.stdout.write(''.join([line + '\n' for line in replies]))
+            return
+        sent = replies.count("OK")
+        if not options.quiet:
+            for cmd, reply in zip(cmds, replies):
+                sys.stderr.write("%s: %s\n" % (cmd, reply))
+            report_throughput(sent, len(cmds), elapsed)
+        if sent != len(cmds):
+            sys.exit(1)
+        return
+
     global EXITCHARCTER, MENUCHARACTER
     EXITCHARCTER = chr(options.exit_char)
     MENUCHARACTER = chr(options.menu_char)
@@ -420,14 +740,51 @@ def main():
     elif options.lf:
         convert_outgoing = CONVERT_LF
 
+    duty = None
+    if options.duty_cycle:
+        try:
+            duty = DutyCycle(options.duty_cycle, options.airtime)
+        except ValueError, e:
+            parser.error(str(e))
+        if options.duty_state is not None:
+            try:
+                duty.load(options.duty_state)
+            except IOError, e:
+                sys.stderr.write("could not read the airtime budget: %s\n" % e)
+                sys.exit(1)
+    elif options.duty_state is not None:
+        parser.error("--duty-state needs --duty-cycle")
+
+    def save_duty():
+        if duty is not None and options.duty_state is not None:
+            try:
+                duty.save(options.duty_state)
+            except (IOError, OSError), e:
+                sys.stderr.write("could not save the airtime budget: %s\n" % e)
+
+    cache = None
+    if options.state_cache is not None:
+        try:
+            cache = statecache.StateCache(options.state_cache, options.state_ttl)
+        except IOError, e:
+            sys.stderr.write("could not read the state cache: %s\n" % e)
+            sys.exit(1)
+
     try:
         miniterm = Miniterm(
             port,
             baudrate,
-            cmd=options.cmd,
+            cmd=cmds,
             echo=options.echo,
             convert_outgoing=convert_outgoing,
-            repr_mode=options.repr_mode
+            repr_mode=options.repr_mode,
+            ack_timeout=options.ack_timeout,
+            retries=options.retries,
+            metrics=options.metrics and Metrics() or None,
+            coalesce=options.coalesce,
+            duty=duty,
+            cache=cache,
+            force=options.force
         )
     except serial.SerialException:
         sys.stderr.write("could not open port %r\n" % port)
@@ -448,8 +805,35 @@ def main():
 #            key_description('\x08'),
 #        ))
 
+    if options.daemon:
+        ok = True
+        try:
+            ok = serve(miniterm, options.socket)
+        except KeyboardInterrupt:
+            pass
+        save_duty()
+        if not ok:
+            sys.exit(1)
+        return
+
+    t = time.time()
     miniterm.start()
+    elapsed = time.time() - t
+    save_duty()
     miniterm.join(True)
+    if not options.quiet and len(cmds) > 1:
+        report_throughput(miniterm.sent, len(cmds), elapsed)
+        if miniterm.saved:
+            sys.stderr.write("--- %d transmissions saved by coalescing ---\n" % miniterm.saved)
+        if miniterm.known:
+            sys.stderr.write("--- %d commands answered from the state cache ---\n" % miniterm.known)
+        if duty is not None and duty.waits:
+            sys.stderr.write("--- airtime: %s ---\n" % duty.describe())
+    if options.metrics:
+        for line in miniterm.metrics.report():
+            sys.stderr.write("--- %s\n" % line)
+    if miniterm.sent != len(cmds):
+        sys.exit(1)
     if not options.quiet:
         sys.stderr.write("\n--- exit ---\n")
     miniterm.join()
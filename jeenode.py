@@ -0,0 +1,242 @@
+# JeeNode receiver messages, the python replacement for jungsend.c's parser
+#
+# the receiver prints every packet as decimal bytes:
+#   OK <size> <header> <house lsb> <house msb> <device lsb> <device msb> <payload...> E
+# where size is the number of payload bytes. the payload is decoded by the
+# decoder registered for the device number, packets from other devices are
+# passed on as they are. device 1 is the energy meter, its 14 byte payload
+# is seq (4), frequency (2), W (4) and kWh (4), all little endian, the last
+# three in tenths. a module adding a sensor node only needs to call
+# register(), e.g.
+#
+#   jeenode.register(2, 'Weather', '<Ihh', 'seq temperature humidity',
+#                    scale={'temperature': 10, 'humidity': 10})
+
+import struct
+from collections import deque
+from collections import namedtuple
+
+MAX_MESSAGE = 255               # longest message kept while waiting for 'E'
+
+Packet = namedtuple('Packet', 'house device header payload')
+
+
+class Decoder:
+    """payload layout of one device type. the struct is compiled once,
+       decoding a packet is one unpack_from plus the scaling."""
+    def __init__(self, device, name, layout, fields, scale=None, text=None):
+        if isinstance(fields, basestring):
+            fields = fields.replace(',', ' ').split()
+        self.device = device
+        self.struct = struct.Struct(layout)
+        count = len(self.struct.unpack('\0' * self.struct.size))
+        if count != len(fields):
+            raise ValueError("layout %r has %d fields, %d names given" % (layout, count, len(fields)))
+        self.record = namedtuple(name, ['house', 'device'] + list(fields))
+        scale = scale or {}
+        self.scaled = [(fields.index(field), float(divisor)) for field, divisor in scale.items()]
+        self.text = text
+
+    def decode(self, house, device, payload):
+        values = self.struct.unpack_from(payload)
+        if self.scaled:
+            values = list(values)
+            for i, divisor in self.scaled:
+                values[i] /= divisor
+        return self.record(house, device, *values)
+
+    def describe(self, record):
+        if self.text is not None:
+            return self.text % record._asdict()
+        return ": " + ', '.join(["%s %s" % item for item in record._asdict().items()[2:]])
+
+
+DECODERS = {}                   # device number -> Decoder
+
+
+def register(device, name, layout, fields, scale=None, text=None, replace=False):
+    """register a decoder for the payloads of `device`: a struct `layout`
+       with one entry per name in `fields`, `scale` maps field names to
+       divisors. returns the record type (a namedtuple with house, device
+       and the fields). `text` is an optional %-format used by describe().
+    """
+    if device in DECODERS and not replace:
+        raise ValueError("device %d already has a decoder" % device)
+    decoder = DECODERS[device] = Decoder(device, name, layout, fields, scale, text)
+    return decoder.record
+
+
+def import_decoders(modules):
+    """import modules (names) that register() their decoders"""
+    for module in modules:
+        __import__(module)
+
+
+ENERGY_METER = 1
+Reading = register(ENERGY_METER, 'Reading', '<IHII', 'seq frequency watts kwh',
+                   scale={'frequency': 10, 'watts': 10, 'kwh': 10},
+                   text=" seq %(seq)d: %(frequency).1f Hz, %(watts).1f W, %(kwh).1f kWh")
+ENERGY = DECODERS[ENERGY_METER].struct
+
+
+def decode(message):
+    """decode one 'OK ...' message (without the trailing 'E') into the
+       record of the device's decoder, or a Packet if there is none or the
+       payload is too short for it. raises ValueError if it is malformed.
+    """
+    tokens = message.split()
+    if not tokens or tokens[0] != 'OK':
+        raise ValueError("not a JeeNode message: %r" % message)
+    values = [int(token) for token in tokens[1:]]
+    if len(values) < 6:
+        raise ValueError("short JeeNode message: %r" % message)
+    for value in values:
+        if not 0 <= value <= 255:
+            raise ValueError("byte out of range in %r" % message)
+    size, header = values[0], values[1]
+    house = values[2] + values[3] * 256
+    device = values[4] + values[5] * 256
+    payload = values[6:]
+    if len(payload) != size:
+        raise ValueError("expected %d payload bytes, got %d" % (size, len(payload)))
+    payload = ''.join(map(chr, payload))
+    decoder = DECODERS.get(device)
+    if decoder is not None and size >= decoder.struct.size:
+        return decoder.decode(house, device, payload)
+    return Packet(house, device, header, payload)
+
+
+class JeeNodeParser:
+    """incremental parser for the receiver's output. feed() takes chunks of
+       any size (packets may be split across reads) and yields the records
+       completed by it. malformed or overlong messages are skipped and
+       counted in `errors`. on_message(text), if given, sees every complete
+       message before it is decoded.
+    """
+    def __init__(self, on_message=None):
+        self.buf = ''
+        self.errors = 0
+        self.on_message = on_message
+
+    def feed(self, data):
+        self.buf += data
+        while True:
+            end = self.buf.find('E')
+            if end < 0:
+                if len(self.buf) > MAX_MESSAGE:
+                    self.buf = ''       # no terminator in sight, resync
+                    self.errors += 1
+                return
+            message = self.buf[:end]
+            self.buf = self.buf[end + 1:]
+            start = message.rfind('OK')
+            if start < 0 or end - start > MAX_MESSAGE:
+                self.errors += 1
+                continue
+            if self.on_message is not None:
+                self.on_message(message[start:].strip())
+            try:
+                yield decode(message[start:])
+            except ValueError:
+                self.errors += 1
+
+
+SEQ_MOD = 2 ** 32
+SEQ_WINDOW = 32                 # recent seqs remembered per device for dedup
+SEQ_MAX_GAP = 10000             # a bigger jump is counted as a restart, not a loss
+
+
+class SeqStats:
+    """counters of one device. `missing` are seqs skipped and not (yet)
+       received, `late` arrived out of order and filled a gap."""
+    def __init__(self):
+        self.received = 0
+        self.duplicates = 0
+        self.missing = 0
+        self.late = 0
+        self.restarts = 0
+        self.last = None
+        self.recent = deque()
+        self.seen = set()
+
+    def loss_rate(self):
+        total = self.received + self.missing
+        return total and float(self.missing) / total or 0.0
+
+    def counters(self):
+        return {'received': self.received, 'duplicates': self.duplicates,
+                'missing': self.missing, 'late': self.late,
+                'restarts': self.restarts, 'loss_rate': self.loss_rate()}
+
+
+class SeqTracker:
+    """per (house, device) sequence tracking for readings. check() tells
+       whether a reading is new, repeated readings within the last `window`
+       seqs are rejected and skipped seqs are counted as missing.
+    """
+    def __init__(self, window=SEQ_WINDOW, max_gap=SEQ_MAX_GAP):
+        self.window = window
+        self.max_gap = max_gap
+        self.devices = {}           # (house, device) -> SeqStats
+
+    def check(self, record):
+        """True for a new reading, False for a duplicate"""
+        key = (record.house, record.device)
+        stats = self.devices.get(key)
+        if stats is None:
+            stats = self.devices[key] = SeqStats()
+        seq = record.seq
+        if seq in stats.seen:
+            stats.duplicates += 1
+            return False
+        if stats.last is not None:
+            ahead = (seq - stats.last) % SEQ_MOD
+            if ahead < SEQ_MOD // 2:
+                if ahead > self.max_gap:
+                    stats.restarts += 1
+                else:
+                    stats.missing += ahead - 1
+                stats.last = seq
+            elif SEQ_MOD - ahead < self.window and stats.missing:
+                stats.missing -= 1      # an older seq that was counted as lost
+                stats.late += 1
+            else:
+                stats.restarts += 1     # the device started counting again
+                stats.last = seq
+        else:
+            stats.last = seq
+        stats.received += 1
+        stats.recent.append(seq)
+        stats.seen.add(seq)
+        if len(stats.recent) > self.window:
+            stats.seen.discard(stats.recent.popleft())
+        return True
+
+    def counters(self):
+        """{(house, device): {counter: value}}"""
+        return dict([(key, stats.counters()) for key, stats in self.devices.items()])
+
+    def describe(self):
+        lines = []
+        for (house, device), stats in sorted(self.devices.items()):
+            lines.append("house %d device %d: %d received, %d duplicates, "
+                "%d missing (%.1f%% loss), %d late, %d restarts" % (
+                house, device, stats.received, stats.duplicates, stats.missing,
+                stats.loss_rate() * 100, stats.late, stats.restarts))
+        return lines
+
+
+def records(chunks):
+    """decode an iterable of byte chunks (a file, a port) into records"""
+    parser = JeeNodeParser()
+    for chunk in chunks:
+        for record in parser.feed(chunk):
+            yield record
+
+
+def describe(record):
+    if not isinstance(record, Packet):
+        return "house %d device %d%s" % (record.house, record.device,
+            DECODERS[record.device].describe(record))
+    return "house %d device %d: %s" % (record.house, record.device,
+        ' '.join([str(b) for b in bytearray(record.payload)]))
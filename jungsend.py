@@ -9,7 +9,13 @@
 # repr, useful for debug purposes)
 
 
-import sys, os, serial, threading, Queue, array, time
+import sys, os, serial, threading, Queue, time, signal
+import insta, engine, jeenode
+from datalog import DataLog
+from energystore import EnergyWriter
+from capture import CaptureWriter
+from engine import RxQueue, RX_POLICIES
+from insta import INQ, ACK
 
 EXITCHARCTER = '\x1d'   # GS/CTRL+]
 MENUCHARACTER = '\x14'  # Menu: CTRL+T
@@ -63,8 +69,10 @@ def get_help_text():
     'exchar': key_description(EXITCHARCTER),
 }
 
-# first choose a platform dependant way to read single characters from the console
-global console
+# first choose a platform dependant way to read single characters from the console.
+# the terminal is left alone until setup_console() is called, only when
+# stdin is a terminal, so importing this module has no side effects
+console = None
 
 if os.name == 'nt':
     import msvcrt
@@ -88,10 +96,8 @@ if os.name == 'nt':
                         return '\n'
                     return z
 
-    console = Console()
-
 elif os.name == 'posix':
-    import termios, sys, os
+    import termios
     class Console:
         def __init__(self):
             self.fd = sys.stdin.fileno()
@@ -112,16 +118,20 @@ elif os.name == 'posix':
         def cleanup(self):
             termios.tcsetattr(self.fd, termios.TCSAFLUSH, self.old)
 
-    console = Console()
-
-    def cleanup_console():
-        console.cleanup()
 
-    console.setup()
-    sys.exitfunc = cleanup_console      #terminal modes have to be restored on exit...
+def cleanup_console():
+    console.cleanup()
 
-else:
-    raise "Sorry no implementation for your platform (%s) available." % sys.platform
+def setup_console():
+    """switch the terminal on stdin to single key input, restored at exit"""
+    global console
+    if console is None:
+        if os.name not in ('nt', 'posix'):
+            raise RuntimeError("Sorry no implementation for your platform (%s) available." % sys.platform)
+        console = Console()
+        console.setup()
+        sys.exitfunc = cleanup_console      #terminal modes have to be restored on exit...
+    return console
 
 
 CONVERT_CRLF = 2
@@ -132,12 +142,14 @@ LF_MODES = ('LF', 'CR', 'CR/LF')
 
 REPR_MODES = ('raw', 'some control', 'all control', 'hex')
 
-INQ = 0xfa
-ACK = 0x05
 CRLF = '\r\n' 
 
 class Miniterm:
-    def __init__(self, queue_rx, queue_tx, port, baudrate, parity, rtscts, xonxoff, cmd, echo=False, convert_outgoing=CONVERT_CRLF, repr_mode=0):
+    """terminal for an INSTA transceiver. the port, the keyboard and the
+       ACK replies are all handled by one engine.Loop running in a single
+       thread; received telegrams are published to queue_rx.
+    """
+    def __init__(self, queue_rx, port, baudrate, parity, rtscts, xonxoff, cmd, echo=False, convert_outgoing=CONVERT_CRLF, repr_mode=0, frame_spacing=0.01, mode='insta', logs=None, capture=None):
         self.serial = serial.Serial(port, baudrate, parity=parity, rtscts=rtscts, xonxoff=xonxoff, timeout=0.7)
         self.echo = echo
         self.repr_mode = repr_mode
@@ -148,24 +160,32 @@ class Miniterm:
         self.cmd = cmd
         self.break_state = False
         self.__queue_rx = queue_rx
-        self.__queue_tx = queue_tx
+        self.loop = engine.Loop()
+        self.logs = logs            # (raw DataLog, EnergyWriter) or None
+        self.capture = capture      # capture.CaptureWriter or None
+        tap = capture is not None and capture.record or None
+        if mode == 'jeenode':
+            self.parser = jeenode.JeeNodeParser(on_message=self.log_raw)
+            self.seqs = jeenode.SeqTracker()
+            self.port = engine.RawPort(self.loop, self.serial, self.show_jeenode, tap=tap)
+        else:
+            self.port = engine.InstaPort(self.loop, self.serial, rx_queue=queue_rx,
+                                         on_items=self.show, frame_spacing=frame_spacing,
+                                         answer_inq=True, tap=tap)
 
 #        self.dump_port_settings()
 
     def start(self):
         self.alive = True
-        # start serial->console thread
-        self.receiver_thread = threading.Thread(target=self.reader)
-        self.receiver_thread.setDaemon(1)
-        self.receiver_thread.start()
-        # enter keyboard handling loop
-        self.keyboard_thread = threading.Thread(target=self.keyb)
-        self.keyboard_thread.setDaemon(1)
-        self.keyboard_thread.start()
-        # enter console->serial loop
-        self.transmitter_thread = threading.Thread(target=self.writer)
-        self.transmitter_thread.setDaemon(1)
-        self.transmitter_thread.start()
+        # keyboard input is handled by the loop as well. without a terminal
+        # (cron, systemd) it runs until the port closes or SIGTERM
+        if sys.stdin.isatty():
+            self.loop.add_reader(setup_console().fd, self.keyb)
+        if self.open_logs():
+            self.loop.call_later(1.0, self.tick_logs)
+        self.loop_thread = threading.Thread(target=self.loop.run)
+        self.loop_thread.setDaemon(1)
+        self.loop_thread.start()
 
         # Send INSTA command        
         if self.cmd == 'A':
@@ -180,12 +200,31 @@ class Miniterm:
 
     def stop(self):
         self.alive = False
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def frames(self, timeout=None):
+        """iterate over (timestamp, insta.Frame) as they are received.
+           stops when nothing arrived for `timeout` seconds (None: never)
+           or the terminal is stopped.
+        """
+        while self.alive:
+            try:
+                yield self.__queue_rx.get(timeout=timeout)
+            except Queue.Empty:
+                return
+
+    def transmit(self, data):
+        """queue bytes for the port, callable from any thread. writes are
+           coalesced and spaced by the engine.
+        """
+        self.loop.call_soon_threadsafe(self.port.write, data)
 
     def join(self, transmit_only=False):
-#        self.transmitter_thread.join()
-        if not transmit_only:
-            self.receiver_thread.join()
-        self.keyboard_thread.join()
+        while self.loop_thread.isAlive():
+            self.loop_thread.join(0.5)      # a join without timeout would block signals
+        for log in self.open_logs():
+            log.close()
+        self.logs = self.capture = None
 
     def dump_port_settings(self):
         sys.stderr.write("\n--- Settings: %s  %s,%s,%s,%s\n" % (
@@ -203,100 +242,100 @@ class Miniterm:
         sys.stderr.write('--- data escaping: %s\n' % (REPR_MODES[self.repr_mode],))
         sys.stderr.write('--- linefeed: %s\n' % (LF_MODES[self.convert_outgoing],))
 
-    def reader(self):
-        """loop and copy serial->console"""
-        while self.alive:
-#            print(self.serial.inWaiting())
-            if self.serial.inWaiting() > 0:
-                data = self.serial.read(1)
-
-                sys.stdout.write("\\x%s " % data.encode('hex'))
-                if data == INQ:
-#                if ord(data) == 0xFA:
-                    try:
-                        self.serial.write(ACK)
-                        self.serial.write(ACK)
-#                        self.serial.write(CRLF)
-                        print "ACK"
-                    except:
-                        print "Serial write exception"
-                        raise
-                    self.serial.flush()
-#                    self.__queue_tx.put(RX_ACK)
-
-                sys.stdout.flush()         
-
-                # Enqueue data
-#                self.__queue_rx.put(data)
-
-    def writer(self):
-        """loop and copy console->serial until EXITCHARCTER character is
-           found. when MENUCHARACTER is found, interpret the next key
-           locally.
+    def dump_seq_stats(self):
+        if isinstance(self.port, engine.RawPort):
+            for line in self.seqs.describe():
+                sys.stderr.write('--- %s\n' % line)
+            sys.stderr.write('--- %d malformed messages\n' % self.parser.errors)
+
+    def show(self, port, items):
+        """copy serial->console, called by the engine for every chunk read.
+           output for the whole chunk is written at once.
         """
-        print "jjj"
-        try:
-            while True:
-                pass
-#                print "k"
-#                item = self.__queue_tx.get()
-#                print len (item)
-#                for character in item:
-#                self.serial.write(item)
-                # Wait for output buffer to drain.
-#                self.serial.flush()
-        except:
-            print "aaa"
-            self.alive = False
-            raise
-        
+        if items is None:
+            sys.stderr.write("\n--- port %s closed ---\n" % port.name)
+            self.stop()
+            return
+        out = []
+        for item in items:
+            if isinstance(item, insta.Frame):
+                out.append("\n%s\n" % insta.describe(item))
+            else:
+                out.append("\\x%02x " % item.byte)
+                if item.byte == INQ:
+                    out.append("ACK\n")
+        sys.stdout.write(''.join(out))
+        sys.stdout.flush()
+
+    def open_logs(self):
+        logs = list(self.logs or ())
+        if self.capture is not None:
+            logs.append(self.capture)
+        return logs
+
+    def tick_logs(self):
+        logs = self.open_logs()
+        if logs:
+            for log in logs:
+                log.tick()
+            self.loop.call_later(1.0, self.tick_logs)
+
+    def log_raw(self, message):
+        if self.logs is not None:
+            self.logs[0].write("%s @ %s\n" % (message, time.asctime()))
+
+    def show_jeenode(self, port, data):
+        """print the packets of a JeeNode receiver, like jungsend.c did"""
+        if data is None:
+            self.show(port, None)
+            return
+        out = []
+        for record in self.parser.feed(data):
+            if hasattr(record, 'seq') and not self.seqs.check(record):
+                continue                # repeated reading
+            if isinstance(record, jeenode.Reading) and self.logs is not None:
+                self.logs[1].append(time.time(), record)
+            out.append("%s\n" % jeenode.describe(record))
+        sys.stdout.write(''.join(out))
+        sys.stdout.flush()
+
+    def sent(self, ok):
+        if ok:
+            sys.stdout.write("_%s_" % insta.describe(insta.decode_frame(insta.VERSION_QUERY)))
+        else:
+            sys.stdout.write("_no ACK_")
+        sys.stdout.flush()
 
     def keyb(self):
-        """loop and copy console->serial until EXITCHARCTER character is
-           found. when MENUCHARACTER is found, interpret the next key
-           locally.
+        """handle one key from the console: EXITCHARCTER stops the terminal,
+           'q' dumps the port settings, 's' sends the version query,
+           everything else is copied to the port.
         """
         try:
-            while self.alive:
-#                print "bbb" 
-                try:
-                    c = console.getkey()
-                except KeyboardInterrupt:
-                    c = '\x03'
-
-                if c == EXITCHARCTER: 
-                    self.stop()
-                    break                                   # exit app
-                elif c == 'q':
-                    self.dump_port_settings()
-                elif c == 's':
-                    if self.echo:
-                        sys.stdout.write("Sending INQ\r\n")
-#                        sys.stdout.write(c)
-#                        sys.stdout.write("\r\n")
-                        sys.stdout.flush()
-                    self.serial.write(chr(INQ))
-                    self.serial.flush()
-                    time.sleep(0.01)
- #            telegram = '\x55\x16\x00\x40\x01\x00\x00\x00\x00\x00\x53\xAA'
-                    telegram = "\x55\x32\xcd\xf1\xfa\x00\x00\x00\x00\x00\xc1\xaa"
-                    self.serial.write(telegram)
-                    self.serial.flush()
-                    sys.stdout.write("_"+telegram+"_")
-                    sys.stdout.flush()
-                elif c == '\n':
-                    self.serial.write(self.newline)         # send newline character(s)
-                    if self.echo:
-                        sys.stdout.write(c)                 # local echo is a real newline in any case
-#                        sys.stdout.flush()
-                else:
-                    self.serial.write(c)                    # send character
-                    if self.echo:
-                        sys.stdout.write(c)
-                        sys.stdout.flush()
-        except:
-            self.alive = False
-            raise
+            c = console.getkey()
+        except KeyboardInterrupt:
+            c = '\x03'
+
+        if c == EXITCHARCTER or c == '':                # exit key or end of input
+            self.loop.remove_reader(console.fd)
+            self.stop()
+        elif c == 'q':
+            self.dump_port_settings()
+            self.dump_seq_stats()
+        elif c == 's' and isinstance(self.port, engine.InstaPort):
+            if self.echo:
+                sys.stdout.write("Sending INQ\r\n")
+                sys.stdout.flush()
+            self.port.send(insta.VERSION_QUERY, self.sent)
+        elif c == '\n':
+            self.port.write(self.newline)               # send newline character(s)
+            if self.echo:
+                sys.stdout.write(c)                     # local echo is a real newline in any case
+        else:
+            self.port.write(c)                          # send character
+            if self.echo:
+                sys.stdout.write(c)
+                sys.stdout.flush()
 
 def main():
     import optparse
@@ -354,6 +393,78 @@ def main():
         default = False
     )
 
+    parser.add_option("--frame-spacing",
+        dest = "frame_spacing",
+        action = "store",
+        type = 'float',
+        help = "minimum seconds between two writes to the radio, default %default",
+        default = 0.01
+    )
+
+    parser.add_option("--rx-policy",
+        dest = "rx_policy",
+        action = "store",
+        help = "what to do when the queue of received telegrams is full: drop-oldest or drop-newest, default %default",
+        default = 'drop-oldest'
+    )
+
+    parser.add_option("--jeenode",
+        dest = "jeenode",
+        action = "store_true",
+        help = "decode the output of a JeeNode receiver instead of INSTA telegrams",
+        default = False
+    )
+
+    parser.add_option("--decoders",
+        dest = "decoders",
+        help = "with --jeenode, comma separated modules registering payload decoders for more device types",
+        default = ""
+    )
+
+    parser.add_option("--log-dir",
+        dest = "log_dir",
+        help = "with --jeenode, append messages to data_raw.dat and readings to the binary store data_energy.dat in this directory",
+        default = None
+    )
+
+    parser.add_option("--capture",
+        dest = "capture",
+        help = "record everything read from and written to the port in this capture file, see capture.py",
+        default = None
+    )
+
+    parser.add_option("--sync-interval",
+        dest = "sync_interval",
+        action = "store",
+        type = 'float',
+        help = "seconds between fsyncs of the log files, default %default",
+        default = 10.0
+    )
+
+    parser.add_option("--sync-records",
+        dest = "sync_records",
+        action = "store",
+        type = 'int',
+        help = "fsync the log files after this many records, default %default",
+        default = 100
+    )
+
+    parser.add_option("--rotate-size",
+        dest = "rotate_size",
+        action = "store",
+        type = 'int',
+        help = "rotate data_raw.dat when it grows beyond this many bytes (default never)",
+        default = None
+    )
+
+    parser.add_option("--rotate-age",
+        dest = "rotate_age",
+        action = "store",
+        type = 'float',
+        help = "rotate data_raw.dat when it is older than this many seconds (default never)",
+        default = None
+    )
+
     parser.add_option("--cr",
         dest = "cr",
         action = "store_true",
@@ -425,6 +536,13 @@ def main():
     if options.parity not in 'NEOSM':
         parser.error("invalid parity")
 
+    if options.rx_policy not in RX_POLICIES:
+        parser.error("invalid --rx-policy")
+    if options.rx_policy == 'block':
+        # nothing reads the queue here (only Miniterm.frames() would), a
+        # full queue would stop the loop thread for good
+        parser.error("--rx-policy block needs a reader of the queue, use drop-oldest or drop-newest")
+
     if options.cr and options.lf:
         parser.error("only one of --cr or --lf can be specified")
 
@@ -461,13 +579,42 @@ def main():
     elif options.lf:
         convert_outgoing = CONVERT_LF
 
-    queue_rx = Queue.Queue(2048)
-    queue_tx = Queue.Queue(2048)
+    queue_rx = RxQueue(2048, options.rx_policy)
+
+    decoders = [name.strip() for name in options.decoders.split(',') if name.strip()]
+    if decoders:
+        if not options.jeenode:
+            parser.error("--decoders needs --jeenode")
+        try:
+            jeenode.import_decoders(decoders)
+        except (ImportError, ValueError), e:
+            parser.error("could not load decoders: %s" % e)
+
+    logs = None
+    if options.log_dir is not None:
+        if not options.jeenode:
+            parser.error("--log-dir needs --jeenode")
+        logs = (DataLog(os.path.join(options.log_dir, 'data_raw.dat'),
+                        sync_interval=options.sync_interval,
+                        sync_records=options.sync_records,
+                        max_bytes=options.rotate_size,
+                        max_age=options.rotate_age),
+                EnergyWriter(os.path.join(options.log_dir, 'data_energy.dat'),
+                             sync_interval=options.sync_interval,
+                             sync_records=options.sync_records,
+                             rollups=True))
+
+    capture = None
+    if options.capture is not None:
+        try:
+            capture = CaptureWriter(options.capture, options.jeenode and 'jeenode' or 'insta',
+                                    sync_interval=options.sync_interval)
+        except (IOError, ValueError), e:
+            parser.error("could not open capture: %s" % e)
 
     try:
         miniterm = Miniterm(
             queue_rx,
-            queue_tx,
             port,
             baudrate,
             options.parity,
@@ -476,7 +623,11 @@ def main():
             cmd=options.cmd,
             echo=options.echo,
             convert_outgoing=convert_outgoing,
-            repr_mode=options.repr_mode
+            repr_mode=options.repr_mode,
+            frame_spacing=options.frame_spacing,
+            mode=options.jeenode and 'jeenode' or 'insta',
+            logs=logs,
+            capture=capture
         )
     except serial.SerialException:
         sys.stderr.write("could not open port %r\n" % port)
@@ -508,10 +659,12 @@ def main():
         miniterm.serial.setRTS(options.rts_state)
         miniterm.rts_state = options.rts_state
 
+    signal.signal(signal.SIGTERM, lambda signum, frame: miniterm.stop())
     miniterm.start()
     miniterm.join(True)
     if not options.quiet:
         sys.stderr.write("\n--- exit ---\n")
+        miniterm.dump_seq_stats()
     miniterm.join()
 
 
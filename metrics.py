@@ -0,0 +1,131 @@
+# Latency histograms for the INQ -> ACK -> telegram exchange
+#
+# the send paths time their phases with observe(); a disabled Metrics
+# returns at once, so instrumented code costs a call and a time.time()
+# when nobody is looking. the daemons dump the histograms as JSON
+# ('stats' on the command socket) or Prometheus text ('metrics').
+
+import time, bisect
+
+# upper bounds in seconds, serial handshakes live between 1 ms and 1 s
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)      # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def cumulative(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+    def as_dict(self):
+        bounds = [str(b) for b in self.buckets] + ['+Inf']
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'buckets': dict(zip(bounds, self.cumulative()))}
+
+
+class Metrics:
+    """named latency histograms and counters. phases are observed in
+       seconds, e.g. metrics.since('ack', inq_sent_at)."""
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.histograms = {}
+        self.counters = {}
+        self.sources = []           # functions returning more counters
+        self.gauge_sources = []     # and gauges (values that go up and down)
+        self.started = time.time()
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def since(self, name, start):
+        """observe the time from `start` until now, returns now"""
+        now = time.time()
+        if self.enabled:
+            self.observe(name, now - start)
+        return now
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_counters(self, source):
+        """include source() (a dict of counters) in the output, also when
+           the histograms are disabled"""
+        self.sources.append(source)
+
+    def add_gauges(self, source):
+        """include source() (a dict of current values) in the output"""
+        self.gauge_sources.append(source)
+
+    def all_gauges(self):
+        gauges = {}
+        for source in self.gauge_sources:
+            gauges.update(source())
+        return gauges
+
+    def all_counters(self):
+        counters = dict(self.counters)
+        for source in self.sources:
+            counters.update(source())
+        return counters
+
+    def as_dict(self):
+        return {'uptime': time.time() - self.started, 'counters': self.all_counters(),
+                'gauges': self.all_gauges(),
+                'phases': dict([(name, h.as_dict()) for name, h in self.histograms.items()])}
+
+    def json(self):
+        import json         # not needed by the one-shot sends, keep startup fast
+        return json.dumps(self.as_dict(), sort_keys=True)
+
+    def prometheus(self, prefix='insta'):
+        """the histograms in the Prometheus text exposition format"""
+        lines = ['# TYPE %s_phase_seconds histogram' % prefix]
+        for name, h in sorted(self.histograms.items()):
+            bounds = ['%g' % b for b in h.buckets] + ['+Inf']
+            for bound, total in zip(bounds, h.cumulative()):
+                lines.append('%s_phase_seconds_bucket{phase="%s",le="%s"} %d' % (prefix, name, bound, total))
+            lines.append('%s_phase_seconds_sum{phase="%s"} %.6f' % (prefix, name, h.sum))
+            lines.append('%s_phase_seconds_count{phase="%s"} %d' % (prefix, name, h.count))
+        for name, value in sorted(self.all_counters().items()):
+            lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+            lines.append('%s_%s_total %d' % (prefix, name, value))
+        for name, value in sorted(self.all_gauges().items()):
+            lines.append('# TYPE %s_%s gauge' % (prefix, name))
+            lines.append('%s_%s %g' % (prefix, name, value))
+        return '\n'.join(lines)
+
+    def report(self):
+        """one line per phase: count, mean, max in ms"""
+        lines = []
+        for name, h in sorted(self.histograms.items()):
+            lines.append("%-15s %6d  mean %8.3f ms  max %8.3f ms" % (
+                name, h.count, h.sum / max(1, h.count) * 1000, h.max * 1000))
+        for name, value in sorted(self.all_counters().items()):
+            lines.append("%-15s %6d" % (name, value))
+        for name, value in sorted(self.all_gauges().items()):
+            lines.append("%-15s %10.4f" % (name, value))
+        return lines
+
+
+DISABLED = Metrics(enabled=False)
@@ -0,0 +1,190 @@
+# Minute/hour/day rollups of the energy meter readings
+#
+# next to data_energy.dat, one file per resolution (data_energy.dat.minute,
+# .hour, .day) holds one fixed size record per bucket:
+#   start (double), count (u32), min W, max W, sum W, kWh at start, kWh at end
+# buckets are aligned to UTC. the open bucket of every resolution lives in
+# memory and is appended to its file when the first reading of the next
+# bucket arrives, so queries cost a binary search plus the buckets returned.
+#
+#  python rollup.py data_energy.dat hour --days 30
+#  python rollup.py data_energy.dat --rebuild
+
+import os, sys, time, struct
+from collections import namedtuple
+from energystore import RecordFile, EnergyReader
+import jeenode
+
+BUCKET = struct.Struct('<dIddddd')
+
+RESOLUTIONS = (('minute', 60), ('hour', 3600), ('day', 86400))
+
+Bucket = namedtuple('Bucket', 'start count min max mean kwh')
+
+
+class Series:
+    """rollups of one resolution: the bucket file plus the open bucket"""
+    def __init__(self, path, seconds):
+        self.path = path
+        self.seconds = seconds
+        self.current = None         # [start, count, min, max, sum, kwh_start, kwh_end]
+        self.kwh = None             # last kWh seen, start of the next bucket
+        if os.path.exists(path):
+            # take the bucket that was open at shutdown back into memory
+            size = os.path.getsize(path) // BUCKET.size * BUCKET.size
+            if size:
+                f = open(path, 'r+b')
+                f.seek(size - BUCKET.size)
+                self.current = list(BUCKET.unpack(f.read(BUCKET.size)))
+                f.truncate(size - BUCKET.size)
+                f.close()
+                self.kwh = self.current[6]
+        self.file = open(path, 'ab')
+        self.reader = None
+
+    def add(self, epoch, watts, kwh):
+        start = epoch - epoch % self.seconds
+        cur = self.current
+        if cur is not None and start > cur[0]:
+            self.file.write(BUCKET.pack(*cur))
+            cur = None
+        if cur is None:
+            if self.kwh is None:
+                self.kwh = kwh
+            cur = self.current = [start, 0, watts, watts, 0.0, self.kwh, kwh]
+        cur[1] += 1
+        cur[2] = min(cur[2], watts)
+        cur[3] = max(cur[3], watts)
+        cur[4] += watts
+        cur[6] = kwh
+        self.kwh = kwh
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.current is not None:
+            self.file.write(BUCKET.pack(*self.current))
+            self.current = None
+        self.file.close()
+        if self.reader is not None:
+            self.reader.close()
+
+    def query(self, start=None, end=None):
+        """buckets whose start lies in [start, end)"""
+        self.file.flush()
+        if self.reader is None:
+            self.reader = RecordFile(self.path, BUCKET)
+        self.reader.refresh()
+        first, last = self.reader.span(start, end)
+        buckets = [bucket(self.reader.unpack(i)) for i in xrange(first, last)]
+        cur = self.current
+        if cur is not None and (start is None or cur[0] >= start) and (end is None or cur[0] < end):
+            buckets.append(bucket(cur))
+        return buckets
+
+
+def query(path, resolution, start=None, end=None):
+    """read-only query of the rollup files of the store `path`, safe while
+       jungsend appends to them. only finished buckets are in the files."""
+    name = "%s.%s" % (path, resolution)
+    if not os.path.exists(name):
+        return []
+    reader = RecordFile(name, BUCKET)
+    first, last = reader.span(start, end)
+    buckets = [bucket(reader.unpack(i)) for i in xrange(first, last)]
+    reader.close()
+    return buckets
+
+
+def bucket(values):
+    start, count, low, high, total, kwh_start, kwh_end = values
+    return Bucket(start, count, low, high, total / count, kwh_end - kwh_start)
+
+
+class Rollups:
+    """minute, hour and day rollups of the energy meter (device 1) readings
+       stored in `path`, updated with add() as readings arrive"""
+    def __init__(self, path, device=jeenode.ENERGY_METER):
+        self.device = device
+        self.series = {}
+        for name, seconds in RESOLUTIONS:
+            self.series[name] = Series("%s.%s" % (path, name), seconds)
+
+    def add(self, epoch, reading):
+        if reading.device != self.device:
+            return
+        for series in self.series.values():
+            series.add(epoch, reading.watts, reading.kwh)
+
+    def flush(self):
+        for series in self.series.values():
+            series.flush()
+
+    def close(self):
+        for series in self.series.values():
+            series.close()
+
+    def query(self, resolution, start=None, end=None):
+        """list of Bucket(start, count, min, max, mean W, delta kWh) for
+           resolution 'minute', 'hour' or 'day'"""
+        return self.series[resolution].query(start, end)
+
+
+def rebuild(path):
+    """recreate the rollup files of the store `path` from its readings"""
+    for name, seconds in RESOLUTIONS:
+        if os.path.exists("%s.%s" % (path, name)):
+            os.unlink("%s.%s" % (path, name))
+    rollups = Rollups(path)
+    reader = EnergyReader(path)
+    for i in xrange(len(reader)):
+        record = reader.record(i)
+        rollups.add(record.epoch, record)
+    reader.close()
+    rollups.close()
+
+
+def main():
+    import optparse
+
+    parser = optparse.OptionParser(
+        usage = "%prog [options] data_energy.dat [minute|hour|day]",
+        description = "Rollup - print minute/hour/day summaries of the energy store."
+    )
+
+    parser.add_option("--days",
+        dest = "days",
+        type = "float",
+        help = "only the last DAYS days",
+        default = None
+    )
+
+    parser.add_option("--rebuild",
+        dest = "rebuild",
+        action = "store_true",
+        help = "recreate the rollup files from the store",
+        default = False
+    )
+
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error("no store given")
+    path = args[0]
+    resolution = len(args) > 1 and args[1] or 'hour'
+    if resolution not in dict(RESOLUTIONS):
+        parser.error("resolution must be one of minute, hour, day")
+
+    if options.rebuild:
+        rebuild(path)
+    start = None
+    if options.days is not None:
+        start = time.time() - options.days * 86400
+    for b in query(path, resolution, start):
+        sys.stdout.write("%s %6d %8.1f %8.1f %8.1f W %8.1f kWh\n" % (
+            time.strftime('%Y-%m-%d %H:%M', time.gmtime(b.start)),
+            b.count, b.min, b.max, b.mean, b.kwh))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# Coalescing send scheduler in front of an engine.InstaPort
+#
+# every telegram costs a full INQ/ACK handshake on the half-duplex radio.
+# commands for a switch (group, channel) that is still waiting for the
+# radio are merged: only the latest state is sent and all their callbacks
+# get its result (last write wins). manual commands go out before
+# scheduled ones, and the scheduler counts the transmissions it saved.
+
+from collections import deque
+import insta
+
+PRIORITIES = ('manual', 'scheduled')
+
+
+def parse_priority(line):
+    """(priority, command) of a command socket line, automation prefixes
+       its commands with 'scheduled ', anything else is manual"""
+    first, sep, rest = line.partition(' ')
+    if sep and first in PRIORITIES:
+        return first, rest.strip()
+    return 'manual', line
+
+
+def switch_key(telegram):
+    """(group, channel) of a switch telegram, None for anything else"""
+    try:
+        frame = insta.decode_frame(telegram)
+        if frame.type != insta.TYPE_SWITCH:
+            return None
+        group, channel, action = insta.decode_switch(frame)
+    except ValueError:
+        return None
+    return group, channel
+
+
+def coalesce(cmds):
+    """last-write-wins for a batch of command names ('a4on', ...): one
+       command per switch, in the order the switches first appear, with
+       the state it was given last. returns [(cmd, merged)] where merged
+       is the number of commands it stands for. unknown commands are kept.
+    """
+    plan = []
+    slots = {}
+    for cmd in cmds:
+        telegram = insta.TELEGRAMS.get(cmd.lower())
+        key = telegram is not None and switch_key(telegram) or None
+        if key is not None and key in slots:
+            slot = slots[key]
+            slot[0] = cmd
+            slot[1] += 1
+        else:
+            slot = [cmd, 1]
+            plan.append(slot)
+            if key is not None:
+                slots[key] = slot
+    return [tuple(slot) for slot in plan]
+
+
+class Scheduler:
+    """one telegram at a time is handed to `port`, the rest wait here
+       where they can still be coalesced."""
+    def __init__(self, port):
+        self.port = port
+        self.queues = dict([(priority, deque()) for priority in PRIORITIES])
+        self.pending = {}           # switch key -> [telegram, callbacks, priority]
+        self.busy = False
+        self.submitted = 0
+        self.transmitted = 0
+        self.saved = 0
+
+    def submit(self, telegram, callback=None, priority='manual'):
+        if priority not in self.queues:
+            raise ValueError("unknown priority %r" % priority)
+        self.submitted += 1
+        key = switch_key(telegram)
+        entry = key is not None and self.pending.get(key)
+        if entry:
+            self.saved += 1
+            entry[0] = telegram
+            entry[1].append(callback)
+            if priority == 'manual' and entry[2] != 'manual':
+                entry[2] = 'manual'
+                self.queues['manual'].append(key)   # its scheduled slot is skipped
+        else:
+            entry = [telegram, [callback], priority]
+            if key is None:
+                key = entry                         # never merged, queued as it is
+            else:
+                self.pending[key] = entry
+            self.queues[priority].append(key)
+        self._next()
+
+    def _next(self):
+        while not self.busy:
+            entry = self._pop()
+            if entry is None:
+                return
+            self.busy = True
+            self.transmitted += 1
+            self.port.send(entry[0], lambda ok, entry=entry: self._sent(entry, ok))
+
+    def _pop(self):
+        for priority in PRIORITIES:
+            queue = self.queues[priority]
+            while queue:
+                key = queue.popleft()
+                if isinstance(key, list):
+                    return key
+                entry = self.pending.get(key)
+                if entry is not None and entry[2] == priority:
+                    del self.pending[key]
+                    return entry
+        return None
+
+    def _sent(self, entry, ok):
+        self.busy = False
+        for callback in entry[1]:
+            if callback is not None:
+                callback(ok)
+        self._next()
+
+    def counters(self):
+        return {'submitted': self.submitted, 'transmitted': self.transmitted,
+                'saved_transmissions': self.saved}
@@ -0,0 +1,244 @@
+# Simulated INSTA transceiver on a pty, for latency and fault testing
+#
+#  python simulator.py --ack-delay 0.05 --drop-ack 0.1 --seed 1
+#  /dev/pts/5
+#  python instasend.py --port /dev/pts/5 -c a4on
+#
+# the simulator answers INQ with ACK and checks the checksum of every
+# telegram that follows, like the real transceiver. faults are injected
+# with a seeded random generator, so a run can be repeated exactly:
+#   ack delay and jitter, ACKs dropped or corrupted, garbage bytes on the
+#   line, and unsolicited telegrams (a remote switch pressed) that may get
+#   line noise in the middle.
+# like the real transceiver it announces an unsolicited telegram with INQ
+# and only sends it once the host ACKed, the INQ is repeated every
+# `inq_timeout` seconds up to `inq_retries` times before it gives up.
+# counters are printed on stderr when it is stopped (Ctrl+C, SIGTERM).
+
+import sys, os, pty, tty, time, heapq, random, select, signal
+import insta
+
+
+class Simulator:
+    """INSTA transceiver on the master side `fd` of a pty.
+
+       ack_delay      seconds between INQ and ACK, plus up to ack_jitter
+       drop_ack       probability that an INQ is not answered
+       corrupt_ack    probability that a wrong byte is sent instead of ACK
+       garbage        probability of random bytes in front of an ACK
+       chatter        unsolicited telegrams per second
+       noise          probability that an unsolicited telegram gets a
+                      corrupted byte in the middle
+    """
+    inq_timeout = 0.5
+    inq_retries = 2
+
+    def __init__(self, fd, ack_delay=0.0, ack_jitter=0.0, drop_ack=0.0, corrupt_ack=0.0,
+                 garbage=0.0, chatter=0.0, noise=0.0, seed=None):
+        self.fd = fd
+        self.ack_delay = ack_delay
+        self.ack_jitter = ack_jitter
+        self.drop_ack = drop_ack
+        self.corrupt_ack = corrupt_ack
+        self.garbage = garbage
+        self.chatter = chatter
+        self.noise = noise
+        self.random = random.Random(seed)
+        self.parser = insta.FrameParser()
+        self.pending = []           # heap of (when, seq, bytes)
+        self.seq = 0
+        self.acked = False          # an ACK was sent, a telegram may follow
+        self.outgoing = []          # unsolicited telegrams waiting for the host's ACK
+        self.inq_deadline = None    # when the INQ for outgoing[0] is repeated
+        self.inq_tries = 0
+        self.inq_written = False    # ACKs only count once that INQ is out
+        self.alive = True
+        self.counters = dict.fromkeys(('inq', 'ack', 'dropped_ack', 'corrupted_ack',
+            'garbage', 'telegrams', 'unexpected_telegrams', 'bad_checksums',
+            'chatter', 'noisy_chatter', 'chatter_delivered', 'undelivered_chatter'), 0)
+
+    def count(self, name):
+        self.counters[name] += 1
+
+    def later(self, delay, data):
+        heapq.heappush(self.pending, (time.time() + delay, self.seq, data))
+        self.seq += 1
+
+    def received(self, data):
+        errors = self.parser.errors
+        for item in self.parser.feed(data):
+            if isinstance(item, insta.Frame):
+                self.count('telegrams')
+                if not self.acked:
+                    self.count('unexpected_telegrams')
+                self.acked = False
+            elif item.byte == insta.INQ:
+                self.count('inq')
+                self.inq()
+            elif item.byte == insta.ACK and self.inq_written:
+                self.deliver()
+        self.counters['bad_checksums'] += self.parser.errors - errors
+
+    def inq(self):
+        rnd = self.random.random
+        if rnd() < self.drop_ack:
+            self.count('dropped_ack')
+            return
+        delay = self.ack_delay + self.ack_jitter * rnd()
+        if rnd() < self.garbage:
+            self.count('garbage')
+            self.later(delay, self.junk(self.random.randint(1, 8)))
+        if rnd() < self.corrupt_ack:
+            self.count('corrupted_ack')
+            self.later(delay, chr(insta.ACK ^ (1 << self.random.randint(0, 7))))
+            return
+        self.count('ack')
+        self.acked = True
+        self.later(delay, chr(insta.ACK))
+
+    def junk(self, n):
+        # anything but the bytes that mean something on this line
+        special = (insta.INQ, insta.ACK, insta.START)
+        out = []
+        while len(out) < n:
+            byte = self.random.randint(0, 255)
+            if byte not in special:
+                out.append(chr(byte))
+        return ''.join(out)
+
+    def unsolicited(self):
+        telegram = insta.TELEGRAMS[self.random.choice(sorted(insta.TELEGRAMS))]
+        self.count('chatter')
+        if self.random.random() < self.noise:
+            self.count('noisy_chatter')
+            i = self.random.randint(1, insta.FRAME_LEN - 2)
+            telegram = telegram[:i] + chr(ord(telegram[i]) ^ 0xff) + telegram[i + 1:]
+        self.outgoing.append(telegram)
+        if self.inq_deadline is None:
+            self.announce()
+
+    def announce(self):
+        """INQ for the first waiting telegram, the host answers with ACK"""
+        self.inq_tries = 0
+        self.inq_deadline = time.time() + self.inq_timeout
+        self.inq_written = False
+        self.later(0, chr(insta.INQ))
+
+    def deliver(self):
+        self.count('chatter_delivered')
+        self.later(0, self.outgoing.pop(0))
+        self.next_outgoing()
+
+    def next_outgoing(self):
+        self.inq_deadline = None
+        self.inq_written = False
+        if self.outgoing:
+            self.announce()
+
+    def inq_expired(self):
+        self.inq_tries += 1
+        if self.inq_tries > self.inq_retries:
+            self.count('undelivered_chatter')
+            self.outgoing.pop(0)
+            self.next_outgoing()
+        else:
+            self.inq_deadline = time.time() + self.inq_timeout
+            self.later(0, chr(insta.INQ))
+
+    def run(self):
+        next_chatter = None
+        if self.chatter:
+            next_chatter = time.time() + self.random.expovariate(self.chatter)
+        while self.alive:
+            now = time.time()
+            while self.pending and self.pending[0][0] <= now:
+                os.write(self.fd, heapq.heappop(self.pending)[2])
+                self.inq_written = self.inq_deadline is not None
+            if next_chatter is not None and next_chatter <= now:
+                self.unsolicited()
+                next_chatter = now + self.random.expovariate(self.chatter)
+                continue
+            if self.inq_deadline is not None and self.inq_deadline <= now:
+                self.inq_expired()
+                continue
+            timeout = None
+            if self.pending:
+                timeout = self.pending[0][0] - now
+            for deadline in (next_chatter, self.inq_deadline):
+                if deadline is not None:
+                    timeout = min(timeout is None and 3600 or timeout, deadline - now)
+            try:
+                readable, w, x = select.select([self.fd], [], [], timeout)
+            except select.error:
+                continue            # interrupted by a signal
+            if readable:
+                try:
+                    data = os.read(self.fd, 256)
+                except OSError:
+                    return          # the other side is gone
+                if not data:
+                    return
+                self.received(data)
+
+    def report(self, out=sys.stderr):
+        for name, value in sorted(self.counters.items()):
+            out.write("%-22s %d\n" % (name, value))
+
+
+def open_pty():
+    """(master fd, slave fd, slave device name) of a new raw pty"""
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    return master, slave, os.ttyname(slave)
+
+
+def main():
+    import optparse
+
+    parser = optparse.OptionParser(
+        usage = "%prog [options]",
+        description = "Simulator - an INSTA transceiver on a pty with injectable faults."
+    )
+
+    for name, help in (
+            ("ack-delay", "seconds between INQ and ACK"),
+            ("ack-jitter", "up to this many seconds added to the ACK delay"),
+            ("drop-ack", "probability that an INQ is not answered"),
+            ("corrupt-ack", "probability that a wrong byte is sent instead of ACK"),
+            ("garbage", "probability of random bytes in front of an ACK"),
+            ("chatter", "unsolicited telegrams per second"),
+            ("noise", "probability of a corrupted byte in an unsolicited telegram")):
+        parser.add_option("--" + name,
+            dest = name.replace('-', '_'),
+            type = "float",
+            help = help + ", default %default",
+            default = 0.0
+        )
+
+    parser.add_option("--seed",
+        dest = "seed",
+        type = "int",
+        help = "seed of the fault generator, for repeatable runs",
+        default = None
+    )
+
+    (options, args) = parser.parse_args()
+
+    master, slave, name = open_pty()
+    simulator = Simulator(master, options.ack_delay, options.ack_jitter, options.drop_ack,
+                          options.corrupt_ack, options.garbage, options.chatter,
+                          options.noise, options.seed)
+    def stop(signum, frame):
+        simulator.alive = False
+    signal.signal(signal.SIGTERM, stop)
+    sys.stdout.write("%s\n" % name)
+    sys.stdout.flush()
+    try:
+        simulator.run()
+    except KeyboardInterrupt:
+        pass
+    simulator.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+# Last known state of the INSTA switches, kept between runs
+#
+#  python instasend.py --port /dev/ttyUSB2 --state-cache /var/tmp/insta.state -c a4on
+#  python instasend.py --port /dev/ttyUSB2 --state-cache /var/tmp/insta.state --force -c a4on
+#
+# rules re-assert state ("a4 on" every minute). with a state cache a switch
+# command is answered locally when the same state was sent to that switch
+# (group, channel) less than `ttl` seconds ago: no INQ/ACK, no telegram.
+# --force (or 'force <command>' on the daemon socket) sends anyway.
+#
+# a failed send forgets the switch and a damaged line in the file is
+# skipped: the cache only answers for states it knows. the daemons (which
+# ACK the transceiver's INQ, see engine.InstaPort) record the switch
+# telegrams other remotes send while they run, so a change made at the
+# wall is not hidden by the cache. one-shot runs do not listen: a change
+# made between them stays hidden until the entry is `ttl` seconds old,
+# keep the TTL short when commands are sent without a daemon.
+#
+# the file has one line per switch:  <group><channel> <on|off> <epoch>
+# it is rewritten in one piece (to <path>.<pid>, then renamed) and merged
+# with what is on disk, so one-shot runs can share it.
+
+import os, errno, time
+import insta
+
+FORCE = 'force'
+TTL = 600.0
+
+
+def parse_force(line):
+    """(force, command) of a command socket line, 'force a4on' is sent even
+       when the cache says a4 is on already"""
+    first, sep, rest = line.partition(' ')
+    if sep and first == FORCE:
+        return True, rest.strip()
+    return False, line
+
+
+def switch_state(telegram):
+    """(group, channel, action) of a switch telegram, None for anything
+       else or a device byte without a known action"""
+    try:
+        frame = insta.decode_frame(telegram)
+        if frame.type != insta.TYPE_SWITCH:
+            return None
+        state = insta.decode_switch(frame)
+    except ValueError:
+        return None
+    if state[2] is None:
+        return None
+    return state
+
+
+def read_states(path):
+    """{(group, channel): (action, epoch)} of a state file, {} if there is none"""
+    states = {}
+    try:
+        f = open(path)
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return states
+        raise
+    try:
+        for line in f:
+            try:
+                switch, action, when = line.split()
+                group, channel = switch[0], int(switch[1:])
+                when = float(when)
+            except ValueError:
+                continue
+            if group in insta.GROUPS and channel in insta.CHANNELS and action in insta.ACTIONS:
+                states[group, channel] = (action, when)
+    finally:
+        f.close()
+    return states
+
+
+class StateCache:
+    """last state sent to each switch, persisted in `path` by save()"""
+    def __init__(self, path, ttl=TTL):
+        self.path = path
+        self.ttl = ttl
+        self.states = read_states(path)
+        self.changes = {}           # (group, channel) -> (action, epoch) or None, not saved yet
+        self.sending = {}           # (group, channel) -> sends in flight
+        self.hits = 0
+        self.misses = 0
+
+    def known(self, telegram):
+        """True if the switch is known to be in the state `telegram` sets:
+           sent less than ttl seconds ago, and nothing else on its way"""
+        state = switch_state(telegram)
+        if state is None:
+            return False
+        key = state[:2]
+        entry = self.states.get(key)
+        if key not in self.sending and entry is not None and entry[0] == state[2] \
+                and time.time() - entry[1] < self.ttl:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def submitted(self, telegram):
+        """a send was queued: until its update() the switch is not known"""
+        state = switch_state(telegram)
+        if state is not None:
+            self.sending[state[:2]] = self.sending.get(state[:2], 0) + 1
+
+    def update(self, telegram, ok=True):
+        """record the state a telegram set, or forget the switch if the
+           telegram was not sent"""
+        state = switch_state(telegram)
+        if state is None:
+            return
+        key = state[:2]
+        if key in self.sending:
+            self.sending[key] -= 1
+            if not self.sending[key]:
+                del self.sending[key]
+        if ok:
+            self._set(key, (state[2], time.time()))
+        elif key in self.states:
+            self._set(key, None)
+
+    def received(self, frame):
+        """a switch telegram from another remote, it set that state"""
+        state = switch_state(insta.encode_frame(frame.type, frame.data))
+        if state is not None:
+            self._set(state[:2], (state[2], time.time()))
+
+    def _set(self, key, entry):
+        if entry is None:
+            del self.states[key]
+        else:
+            self.states[key] = entry
+        self.changes[key] = entry
+
+    def save(self):
+        """write the changes, on top of what other runs saved meanwhile"""
+        if not self.changes:
+            return
+        states = read_states(self.path)
+        for key, entry in self.changes.items():
+            if entry is None:
+                states.pop(key, None)
+            else:
+                states[key] = entry
+        tmp = '%s.%d' % (self.path, os.getpid())
+        f = open(tmp, 'w')
+        try:
+            for (group, channel), (action, when) in sorted(states.items()):
+                f.write("%s%d %s %.3f\n" % (group, channel, action, when))
+        finally:
+            f.close()
+        if os.name != 'posix' and os.path.exists(self.path):
+            os.remove(self.path)    # rename does not replace files there
+        os.rename(tmp, self.path)
+        self.states = states
+        self.changes = {}
+
+    def counters(self):
+        return {'state_cache_hits': self.hits, 'state_cache_misses': self.misses}
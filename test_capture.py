@@ -0,0 +1,47 @@
+# Capture files written across crashes and restarts
+#
+#  python -m unittest test_capture
+
+import os, shutil, tempfile, unittest
+import capture
+from capture import CaptureWriter, read_capture, RX, TX
+
+
+class CaptureWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'field.cap')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def chunks(self):
+        kind, started, records = read_capture(self.path)
+        return [(direction, data) for offset, direction, data in records]
+
+    def test_append_after_torn_record(self):
+        writer = CaptureWriter(self.path, 'insta')
+        writer.record(RX, 'first')
+        writer.record(TX, 'second')
+        writer.close()
+        f = open(self.path, 'r+b')
+        f.truncate(os.path.getsize(self.path) - 2)
+        f.close()
+        writer = CaptureWriter(self.path, 'insta')
+        writer.record(RX, 'third')
+        writer.close()
+        self.assertEqual(self.chunks(), [(RX, 'first'), (RX, 'third')])
+
+    def test_append_checks_kind_and_version(self):
+        CaptureWriter(self.path, 'insta').close()
+        self.assertRaises(ValueError, CaptureWriter, self.path, 'jeenode')
+        f = open(self.path, 'r+b')
+        f.seek(4)
+        f.write(chr(capture.VERSION + 1))
+        f.close()
+        self.assertRaises(ValueError, CaptureWriter, self.path, 'insta')
+        self.assertRaises(ValueError, read_capture, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+# Airtime budget shared through a state file
+#
+#  python -m unittest test_dutycycle
+
+import os, shutil, tempfile, unittest
+from dutycycle import DutyCycle, read_bucket
+
+
+class StateFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'insta.duty')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_overlapping_runs_keep_each_others_airtime(self):
+        first, second = DutyCycle(0.1, 1.0), DutyCycle(0.1, 1.0)
+        first.load(self.path)
+        second.load(self.path)
+        first.spend()
+        second.spend()
+        second.spend()
+        first.save(self.path)
+        second.save(self.path)
+        tokens, updated, recent = read_bucket(self.path)
+        self.assertEqual(len(recent), 3)
+        self.assertTrue(tokens < first.capacity - 2.9)
+        third = DutyCycle(0.1, 1.0)
+        third.load(self.path)
+        self.assertAlmostEqual(third.recent_airtime, 3.0)
+
+    def test_damaged_file_is_an_empty_bucket(self):
+        f = open(self.path, 'w')
+        f.write("garbage\n")
+        f.close()
+        duty = DutyCycle(0.1, 1.0)
+        duty.load(self.path)
+        self.assertTrue(duty.delay() > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# Regression tests for the INSTA framing
+#
+#  python -m unittest test_insta
+
+import unittest
+import insta
+from insta import FrameParser, Frame, Control, INQ, ACK, START
+
+
+class FrameParserTest(unittest.TestCase):
+    def test_telegram_in_chunks(self):
+        parser = FrameParser()
+        telegram = insta.TELEGRAMS['a4on']
+        self.assertEqual(parser.feed(telegram[:5]), [])
+        items = parser.feed(telegram[5:] + chr(ACK))
+        self.assertEqual(items, [insta.decode_frame(telegram), Control(ACK)])
+
+    def test_stray_start_does_not_hold_back_ack(self):
+        parser = FrameParser()
+        self.assertEqual(parser.feed(chr(START) + chr(ACK)), [Control(START), Control(ACK)])
+        self.assertEqual(parser.errors, 1)
+
+    def test_stray_start_before_telegram(self):
+        parser = FrameParser()
+        telegram = insta.TELEGRAMS['b2off']
+        items = parser.feed(chr(INQ) + chr(START) + telegram)
+        self.assertEqual(items, [Control(INQ), Control(START), insta.decode_frame(telegram)])
+
+    def test_unknown_type_is_handed_out(self):
+        parser = FrameParser()
+        telegram = insta.encode_frame(0x41, '\x01\x02\x03\x04\x05\x06\x07\x08')
+        self.assertEqual(parser.feed(telegram + chr(ACK)), [insta.decode_frame(telegram), Control(ACK)])
+        self.assertEqual((parser.errors, parser.unknown), (0, 1))
+
+    def test_flush_releases_a_stalled_start(self):
+        parser = FrameParser()
+        self.assertEqual(parser.feed(chr(START) + chr(insta.TYPE_SWITCH) + chr(ACK)), [])
+        self.assertEqual(parser.flush(), [Control(START), Control(insta.TYPE_SWITCH), Control(ACK)])
+        self.assertEqual(parser.errors, 1)
+
+    def test_bad_checksum_resyncs(self):
+        parser = FrameParser()
+        telegram = insta.TELEGRAMS['c1on']
+        broken = telegram[:10] + chr(ord(telegram[10]) ^ 1) + telegram[11:]
+        items = parser.feed(broken + telegram)
+        self.assertEqual(items[-1], insta.decode_frame(telegram))
+        self.assertTrue(isinstance(items[0], Control))
+        self.assertEqual(parser.errors, 1)
+
+
+class SwitchTest(unittest.TestCase):
+    def test_unknown_group_bits(self):
+        frame = insta.decode_frame(insta.encode_frame(insta.TYPE_SWITCH, '\x00\x58\x01\x00\x00\x00\x00\x00'))
+        self.assertRaises(ValueError, insta.decode_switch, frame)
+        self.assertTrue(insta.describe(frame).startswith('telegram type 0x16'))
+
+    def test_round_trip(self):
+        for cmd, telegram in insta.TELEGRAMS.items():
+            group, channel, action = insta.decode_switch(insta.decode_frame(telegram))
+            self.assertEqual('%s%d%s' % (group, channel, action), cmd)
+
+
+if __name__ == '__main__':
+    unittest.main()
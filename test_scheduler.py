@@ -0,0 +1,54 @@
+# Scheduler and InstaPort against the simulator on a pty
+#
+#  python -m unittest test_scheduler
+
+import os, time, threading, unittest
+import serial
+import engine, insta, scheduler, simulator
+
+
+class ScheduledSendTest(unittest.TestCase):
+    def setUp(self):
+        self.master, self.slave, name = simulator.open_pty()
+        self.sim = simulator.Simulator(self.master)
+        self.thread = threading.Thread(target=self.sim.run)
+        self.thread.start()
+        self.loop = engine.Loop()
+        self.writes = []            # (time, bytes) of every write to the port
+        self.port = engine.InstaPort(self.loop, serial.Serial(name, 9600, timeout=0),
+                                     frame_spacing=0.05, tap=self.tap)
+
+    def tearDown(self):
+        self.sim.alive = False
+        os.write(self.slave, chr(insta.ACK))    # wakes the simulator up
+        self.thread.join()
+        self.port.close()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def tap(self, direction, data):
+        if direction == engine.TX:
+            self.writes.append((time.time(), data))
+
+    def test_telegrams_are_separate_writes(self):
+        results = []
+        def sent(ok):
+            results.append(ok)
+            if len(results) == 2:
+                self.loop.call_later(0.2, self.loop.stop)   # the last telegram is written after its ACK
+        s = scheduler.Scheduler(self.port)
+        for cmd in ('a4on', 'b2off'):
+            s.submit(insta.TELEGRAMS[cmd], sent)
+        self.loop.call_later(5.0, self.loop.stop)
+        self.loop.run()
+        self.assertEqual(results, [True, True])
+        self.assertEqual([data for when, data in self.writes],
+                         [chr(insta.INQ), insta.TELEGRAMS['a4on'], chr(insta.INQ), insta.TELEGRAMS['b2off']])
+        for (before, data), (after, next) in zip(self.writes, self.writes[1:]):
+            self.assertTrue(after - before >= self.port.frame_spacing,
+                            "%r followed %r after %.3f s" % (next, data, after - before))
+        self.assertEqual(self.sim.counters['unexpected_telegrams'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()